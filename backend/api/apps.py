@@ -5,3 +5,10 @@ class ApiConfig(AppConfig):
     '''Api application.'''
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from api import authentication, membership
+        from foodgram import db
+        membership.connect_signals()
+        authentication.connect_signals()
+        db.connect_signals()
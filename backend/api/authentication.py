@@ -0,0 +1,204 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from foodgram.db import read_primary
+from foodgram.settings import TOKEN_CACHE
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.permissions import SAFE_METHODS
+
+User = get_user_model()
+
+
+class _Entry:
+
+    __slots__ = ('user', 'version', 'expires')
+
+    def __init__(self, user, version, expires):
+        self.user = user
+        self.version = version
+        self.expires = expires
+
+
+class TokenCache:
+    '''Users of tokens, in a process-local LRU keyed by the token hash.
+
+    Logout, a saved user and a deleted user drop the entries of the user.
+    When ALIAS names a shared cache (memcached), each user has a version
+    there that these changes bump, so other processes drop the entries on
+    their next request. Without one, other processes cannot know, the
+    entries only live for local_ttl.
+    '''
+
+    def __init__(self, alias=None, max_tokens=10000, ttl=60, local_ttl=1):
+        self.alias = alias
+        self.max_tokens = max_tokens
+        self.ttl = ttl if alias else local_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    @property
+    def _shared(self):
+        return caches[self.alias] if self.alias else None
+
+    def _version_key(self, user_id):
+        return f'token:version:{user_id}'
+
+    def _user_key(self, digest):
+        return f'token:user:{digest}'
+
+    def _get_version(self, user_id):
+        if self._shared is None:
+            return None
+        return self._shared.get(self._version_key(user_id), 0)
+
+    def _forget(self, digest):
+        entry = self._entries.pop(digest, None)
+        if entry is not None:
+            digests = self._by_user.get(entry.user.pk)
+            digests.discard(digest)
+            if not digests:
+                del self._by_user[entry.user.pk]
+
+    def get_user(self, key, load):
+        '''A copy of the user of the token, from the cache or load(key).'''
+        digest = sha256(key.encode()).hexdigest()
+        with self._lock:
+            entry = self._entries.get(digest)
+        if (
+            entry is not None and entry.expires > time.monotonic()
+            and entry.version == self._get_version(entry.user.pk)
+        ):
+            with self._lock:
+                if digest in self._entries:
+                    self._entries.move_to_end(digest)
+                self.hits += 1
+            # Views may change request.user, the cached one stays as is.
+            return copy.copy(entry.user)
+
+        # The versions are read before the user, an invalidation between
+        # the two leaves a stale version instead of a stale user. The user
+        # of the token is known in the shared cache from its first load.
+        with self._lock:
+            invalidations = self._invalidations
+        user_id = version = None
+        if self._shared is not None:
+            user_id = self._shared.get(self._user_key(digest))
+            if user_id is not None:
+                version = self._get_version(user_id)
+        user = load(key)
+        if self._shared is not None and user_id != user.pk:
+            self._shared.set(self._user_key(digest), user.pk, None)
+            invalidations = None
+        with self._lock:
+            self.misses += 1
+            self._forget(digest)
+            if invalidations != self._invalidations:
+                return user
+            self._entries[digest] = _Entry(
+                copy.copy(user), version, time.monotonic() + self.ttl
+            )
+            self._by_user.setdefault(user.pk, set()).add(digest)
+            while len(self._entries) > self.max_tokens:
+                self._forget(next(iter(self._entries)))
+        return user
+
+    def invalidate(self, user_id):
+        '''Drop the tokens of the user here and, if shared, everywhere.'''
+        if self._shared is not None:
+            key = self._version_key(user_id)
+            self._shared.add(key, 0, timeout=None)
+            try:
+                self._shared.incr(key)
+            except ValueError:
+                # Evicted in the meantime, a missing version is 0.
+                self._shared.set(key, 1, timeout=None)
+        with self._lock:
+            self._invalidations += 1
+            for digest in list(self._by_user.get(user_id, ())):
+                self._forget(digest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            entries = len(self._entries)
+        requests = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / requests if requests else None,
+            'entries': entries,
+        }
+
+
+token_cache = TokenCache(
+    alias=TOKEN_CACHE['ALIAS'],
+    max_tokens=TOKEN_CACHE['MAX_TOKENS'],
+    ttl=TOKEN_CACHE['TTL'],
+    local_ttl=TOKEN_CACHE['LOCAL_TTL'],
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''TokenAuthentication without a query for a token seen recently.
+
+    Unknown tokens and inactive users are never cached, they fail in
+    TokenAuthentication on every request. Unsafe requests load the user:
+    a view may save request.user, a cached copy would write back stale
+    fields such as is_active. Tokens are looked up on the primary: a
+    replica may not have a token issued a moment ago.
+    '''
+
+    def authenticate(self, request):
+        self.cached = request.method in SAFE_METHODS
+        return super().authenticate(request)
+
+    def authenticate_credentials(self, key):
+        if self.cached:
+            user = token_cache.get_user(key, self._load_user)
+        else:
+            user = self._load_user(key)
+        return user, Token(key=key, user=user)
+
+    def _load_user(self, key):
+        with read_primary():
+            user, _ = super().authenticate_credentials(key)
+        return user
+
+
+def _user_changed(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: token_cache.invalidate(user_id))
+
+
+def _token_deleted(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: token_cache.invalidate(user_id))
+
+
+def connect_signals():
+    post_save.connect(
+        _user_changed, sender=User, dispatch_uid='token_cache_user_saved',
+    )
+    post_delete.connect(
+        _user_changed, sender=User, dispatch_uid='token_cache_user_deleted',
+    )
+    post_delete.connect(
+        _token_deleted, sender=Token, dispatch_uid='token_cache_deleted',
+    )
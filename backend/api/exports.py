@@ -0,0 +1,363 @@
+import csv
+import os
+import threading
+import zlib
+from functools import lru_cache
+from itertools import chain
+
+from foodgram.settings import BASE_DIR
+from reportlab.pdfbase.ttfonts import TTFontFile
+from rest_framework.exceptions import ValidationError
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+FONT_PATH = os.path.join(BASE_DIR, 'recipes', 'fonts', 'Lobster.ttf')
+CHUNK_SIZE = 8 * 1024
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+MARGIN = 50
+TITLE_SIZE, FONT_SIZE, LEADING = 16, 12, 18
+TITLE = 'Список покупок'
+
+
+def _chunked(parts, size=CHUNK_SIZE):
+    '''Join small pieces into chunks of about size bytes.'''
+    buffer, length = [], 0
+    for part in parts:
+        buffer.append(part)
+        length += len(part)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _format_line(name, unit, amount):
+    return f'{name} ({unit}) - {amount}'
+
+
+def stream_txt(rows):
+    return _chunked(
+        f'{_format_line(*row)}\n'.encode() for row in rows
+    )
+
+
+class _Echo:
+    '''File-like object that hands back what csv.writer writes to it.'''
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    header = ('Ингредиент', 'Единица измерения', 'Количество')
+    return _chunked(
+        writer.writerow(row).encode() for row in chain((header,), rows)
+    )
+
+
+@lru_cache(maxsize=None)
+def _font():
+    return TTFontFile(FONT_PATH, validate=0)
+
+
+# makeSubset reads the font file through a shared position.
+_subset_lock = threading.Lock()
+
+
+class _Widths(dict):
+    '''Advance widths of characters in thousandths of the font size.'''
+
+    def __init__(self, font):
+        super().__init__()
+        self.font = font
+
+    def __missing__(self, char):
+        self[char] = self.font.charWidths.get(
+            ord(char), self.font.defaultWidth
+        )
+        return self[char]
+
+
+class _PDFWriter:
+    '''Minimal PDF writer that emits each page as soon as it is complete.
+
+    Only page offsets and the glyphs used are kept. Glyphs are numbered
+    in the order reportlab's makeSubset gives them, so the pages can use
+    the ids of the subset that is embedded once the pages are written.
+    '''
+    CATALOG, PAGES, FONT, CID_FONT, DESCRIPTOR, FONT_FILE, TO_UNICODE = (
+        range(1, 8)
+    )
+
+    def __init__(self):
+        self.font = _font()
+        self.offsets = {}
+        self.position = 0
+        self.next_number = self.TO_UNICODE + 1
+        self.pages = []
+        self.glyphs = {}
+        self.codes = {}
+        self.subset = []
+        self.subset_glyphs = {0: 0}
+        self.widths = _Widths(self.font)
+
+    def _write(self, data):
+        self.position += len(data)
+        return data
+
+    def _object(self, number, body, stream=None):
+        self.offsets[number] = self.position
+        data = f'{number} 0 obj\n'.encode() + body
+        if stream is not None:
+            data += b'\nstream\n' + stream + b'\nendstream'
+        return self._write(data + b'\nendobj\n')
+
+    def _encode(self, text):
+        '''Subset glyph ids as a hex string for the Identity-H encoding.'''
+        codes = self.codes
+        for char in dict.fromkeys(text):
+            if char in codes:
+                continue
+            original = self.font.charToGlyph.get(ord(char), 0)
+            glyph = self.subset_glyphs.setdefault(
+                original, len(self.subset_glyphs)
+            )
+            self.subset.append(ord(char))
+            self.glyphs.setdefault(glyph, char)
+            codes[char] = f'{glyph:04X}'
+        return '<' + ''.join(map(codes.__getitem__, text)) + '>'
+
+    def width(self, text):
+        '''Width of text in thousandths of the font size.'''
+        return sum(map(self.widths.__getitem__, text))
+
+    def wrap(self, text, size, width=PAGE_WIDTH - 2 * MARGIN):
+        '''Lines of text that fit into width, broken between words.'''
+        width = width * 1000 / size
+        if self.width(text) <= width:
+            return [text]
+        space = self.width(' ')
+        lines, line, line_width = [], '', 0
+        for word in text.split(' '):
+            word_width = self.width(word)
+            if line and line_width + space + word_width <= width:
+                line, line_width = f'{line} {word}', line_width + space + (
+                    word_width
+                )
+                continue
+            if line:
+                lines.append(line)
+            line, line_width = '', 0
+            if word_width <= width:
+                line, line_width = word, word_width
+                continue
+            # A word longer than a line is broken between characters.
+            for char in word:
+                char_width = self.width(char)
+                if line and line_width + char_width > width:
+                    lines.append(line)
+                    line, line_width = '', 0
+                line, line_width = line + char, line_width + char_width
+        lines.append(line)
+        return lines
+
+    def header(self):
+        return self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def page(self, lines, title=None):
+        commands = ['BT', f'{MARGIN} {PAGE_HEIGHT - MARGIN} Td']
+        if title is not None:
+            commands += [
+                f'/F1 {TITLE_SIZE} Tf', f'{self._encode(title)} Tj',
+                f'0 {-2 * LEADING} Td',
+            ]
+        commands += [f'/F1 {FONT_SIZE} Tf', f'{LEADING} TL']
+        for line in lines:
+            commands += [f'{self._encode(line)} Tj', 'T*']
+        commands.append('ET')
+        content = zlib.compress('\n'.join(commands).encode())
+
+        content_number, page_number = self.next_number, self.next_number + 1
+        self.next_number += 2
+        self.pages.append(page_number)
+        return self._object(
+            content_number,
+            f'<< /Length {len(content)} /Filter /FlateDecode >>'.encode(),
+            content,
+        ) + self._object(
+            page_number,
+            f'<< /Type /Page /Parent {self.PAGES} 0 R '
+            f'/MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+            f'/Resources << /Font << /F1 {self.FONT} 0 R >> >> '
+            f'/Contents {content_number} 0 R >>'.encode(),
+        )
+
+    def _widths(self):
+        widths, default = self.font.charWidths, self.font.defaultWidth
+        return ' '.join(
+            f'{glyph} [{widths.get(ord(char), default):.0f}]'
+            for glyph, char in sorted(self.glyphs.items())
+        )
+
+    def _to_unicode(self):
+        mappings = [
+            f'<{glyph:04X}> <{ord(char):04X}>'
+            for glyph, char in sorted(self.glyphs.items())
+        ]
+        blocks = []
+        for start in range(0, len(mappings), 100):
+            block = mappings[start:start + 100]
+            blocks.append(
+                f'{len(block)} beginbfchar\n' + '\n'.join(block)
+                + '\nendbfchar'
+            )
+        return (
+            '/CIDInit /ProcSet findresource begin\n12 dict begin\n'
+            'begincmap\n/CIDSystemInfo << /Registry (Adobe) '
+            '/Ordering (UCS) /Supplement 0 >> def\n'
+            '/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n'
+            '1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n'
+            + '\n'.join(blocks)
+            + '\nendcmap\nCMapName currentdict /CMap defineresource pop\n'
+            'end\nend'
+        ).encode()
+
+    def trailer(self):
+        '''Everything after the pages: font, page tree, xref, trailer.'''
+        font = self.font
+        # A subset font is named with a tag of six capital letters.
+        name = 'FGLIST+' + font.name.decode()
+        kids = ' '.join(f'{number} 0 R' for number in self.pages)
+        yield self._object(
+            self.PAGES,
+            f'<< /Type /Pages /Kids [{kids}] '
+            f'/Count {len(self.pages)} >>'.encode(),
+        )
+        yield self._object(
+            self.FONT,
+            f'<< /Type /Font /Subtype /Type0 /BaseFont /{name} '
+            f'/Encoding /Identity-H /DescendantFonts [{self.CID_FONT} 0 R] '
+            f'/ToUnicode {self.TO_UNICODE} 0 R >>'.encode(),
+        )
+        yield self._object(
+            self.CID_FONT,
+            f'<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{name} '
+            '/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) '
+            f'/Supplement 0 >> /FontDescriptor {self.DESCRIPTOR} 0 R '
+            f'/DW {font.defaultWidth:.0f} /W [{self._widths()}] '
+            '/CIDToGIDMap /Identity >>'.encode(),
+        )
+        bbox = ' '.join(f'{value:.0f}' for value in font.bbox)
+        yield self._object(
+            self.DESCRIPTOR,
+            f'<< /Type /FontDescriptor /FontName /{name} '
+            f'/Flags {font.flags} /FontBBox [{bbox}] '
+            f'/ItalicAngle {font.italicAngle:.0f} /Ascent {font.ascent:.0f} '
+            f'/Descent {font.descent:.0f} /CapHeight {font.capHeight:.0f} '
+            f'/StemV {font.stemV} /FontFile2 {self.FONT_FILE} 0 R >>'.encode(),
+        )
+        yield from self._font_file()
+        to_unicode = zlib.compress(self._to_unicode())
+        yield self._object(
+            self.TO_UNICODE,
+            f'<< /Length {len(to_unicode)} /Filter /FlateDecode >>'.encode(),
+            to_unicode,
+        )
+        yield self._object(
+            self.CATALOG,
+            f'<< /Type /Catalog /Pages {self.PAGES} 0 R >>'.encode(),
+        )
+
+        xref_position = self.position
+        size = self.next_number
+        entries = ''.join(
+            f'{self.offsets[number]:010d} 00000 n \n'
+            for number in range(1, size)
+        )
+        yield self._write(
+            f'xref\n0 {size}\n0000000000 65535 f \n{entries}'
+            f'trailer\n<< /Size {size} /Root {self.CATALOG} 0 R >>\n'
+            f'startxref\n{xref_position}\n%%EOF\n'.encode()
+        )
+
+    def _font_file(self):
+        '''A TrueType font with only the glyphs used.'''
+        with _subset_lock:
+            subset = self.font.makeSubset(self.subset)
+        data = zlib.compress(subset)
+        yield self._object(
+            self.FONT_FILE,
+            f'<< /Length {len(data)} /Length1 {len(subset)} '
+            '/Filter /FlateDecode >>'.encode(),
+            data,
+        )
+
+
+def stream_pdf(rows):
+    writer = _PDFWriter()
+    yield writer.header()
+    lines_per_page = (PAGE_HEIGHT - 2 * MARGIN) // LEADING
+    title, lines = TITLE, []
+    for row in rows:
+        for line in writer.wrap(_format_line(*row), FONT_SIZE):
+            lines.append(line)
+            # The title takes the place of two lines on the first page.
+            if len(lines) >= lines_per_page - (2 if title else 0):
+                yield writer.page(lines, title)
+                title, lines = None, []
+    if lines or title:
+        yield writer.page(lines, title)
+    yield from writer.trailer()
+
+
+class ExportRenderer(BaseRenderer):
+    '''Export formats selected with ?format=, the body is streamed.
+
+    The renderer only renders error responses, the content of an export
+    comes from stream().
+    '''
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return JSONRenderer().render(data)
+
+
+class TxtExportRenderer(ExportRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+    stream = staticmethod(stream_txt)
+
+
+class CsvExportRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    stream = staticmethod(stream_csv)
+
+
+class PdfExportRenderer(ExportRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+    stream = staticmethod(stream_pdf)
+
+
+class ExportFormatNegotiation(BaseContentNegotiation):
+    '''Pick the export format from ?format= only, the first is default.'''
+
+    def select_parser(self, request, parsers):
+        return parsers[0] if parsers else None
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        export_format = format_suffix or request.query_params.get('format')
+        if not export_format:
+            return renderers[0], renderers[0].media_type
+        for renderer in renderers:
+            if renderer.format == export_format:
+                return renderer, renderer.media_type
+        raise ValidationError({'format': [
+            'Unsupported format, use one of: {}.'.format(', '.join(
+                renderer.format for renderer in renderers
+            )),
+        ]})
@@ -0,0 +1,160 @@
+import binascii
+from base64 import b64decode
+from uuid import uuid4
+
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from foodgram.settings import IMAGE_DERIVATIVES, IMAGE_UPLOAD
+from PIL import Image
+from recipes.images import FORMATS
+from rest_framework import serializers
+from rest_framework.relations import (MANY_RELATION_KWARGS, ManyRelatedField,
+                                      PrimaryKeyRelatedField)
+
+
+class BulkManyRelatedField(ManyRelatedField):
+    '''Looks every primary key of the list up in a single IN query.'''
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+
+        child = self.child_relation
+        queryset = child.get_queryset()
+        pks = []
+        for pk in data:
+            if isinstance(pk, bool):
+                child.fail('incorrect_type', data_type=type(pk).__name__)
+            try:
+                pks.append(queryset.model._meta.pk.to_python(pk))
+            except (TypeError, ValueError, ValidationError):
+                child.fail('incorrect_type', data_type=type(pk).__name__)
+
+        objects = queryset.in_bulk(set(pks))
+        for pk in pks:
+            if pk not in objects:
+                child.fail('does_not_exist', pk_value=pk)
+        return [objects[pk] for pk in pks]
+
+
+class BulkPrimaryKeyRelatedField(PrimaryKeyRelatedField):
+    '''PrimaryKeyRelatedField whose many=True form validates in bulk.'''
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return BulkManyRelatedField(**list_kwargs)
+
+
+class SpooledImageField(serializers.ImageField):
+    '''Image given as a multipart upload or as a base64 string.
+
+    The size limit is checked against the length of the base64 string and
+    the pixel limit against the image header, before anything is decoded
+    in full. Base64 data is decoded chunk by chunk into a temporary file,
+    so Pillow verifies the image from disk.
+    '''
+    default_error_messages = {
+        'too_large': 'The image must not be larger than {max_bytes} bytes.',
+        'too_many_pixels': (
+            'The image must not have more than {max_pixels} pixels.'
+        ),
+        'invalid_base64': 'The image is not valid base64 data.',
+    }
+    formats = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+    chunk_size = 64 * 1024
+
+    def __init__(self, max_bytes=IMAGE_UPLOAD['MAX_BYTES'],
+                 max_pixels=IMAGE_UPLOAD['MAX_PIXELS'], **kwargs):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = self._decode(data)
+        elif not hasattr(data, 'read'):
+            self.fail('invalid')
+        elif data.size > self.max_bytes:
+            self.fail('too_large', max_bytes=self.max_bytes)
+        data.name = f'{uuid4()}.{self._check_header(data)}'
+        return super().to_internal_value(data)
+
+    def _decode(self, data):
+        start = data.find(';base64,', 0, 256)
+        start = 0 if start < 0 else start + len(';base64,')
+        if (len(data) - start) // 4 * 3 > self.max_bytes:
+            self.fail('too_large', max_bytes=self.max_bytes)
+
+        upload = TemporaryUploadedFile('image', None, 0, None)
+        # A multiple of 4 characters decodes on its own.
+        step = self.chunk_size // 4 * 4
+        try:
+            for position in range(start, len(data), step):
+                upload.write(b64decode(
+                    data[position:position + step], validate=True
+                ))
+        except (binascii.Error, ValueError):
+            upload.close()
+            self.fail('invalid_base64')
+        upload.size = upload.tell()
+        upload.seek(0)
+        return upload
+
+    def _check_header(self, file):
+        '''Read the dimensions and format only, return the extension.'''
+        try:
+            with Image.open(file) as image:
+                pixels = image.width * image.height
+                extension = self.formats.get(image.format)
+        except Image.DecompressionBombError:
+            self.fail('too_many_pixels', max_pixels=self.max_pixels)
+        except OSError:
+            self.fail('invalid_image')
+        finally:
+            file.seek(0)
+
+        if pixels > self.max_pixels:
+            self.fail('too_many_pixels', max_pixels=self.max_pixels)
+        if extension is None:
+            self.fail('invalid_image')
+        return extension
+
+
+class ImageDerivativesField(serializers.Field):
+    '''URLs of the resized copies of a recipe image, per size and format.
+
+    Sizes that are not generated yet point to the original image.
+    '''
+
+    def __init__(self, sizes=None, **kwargs):
+        self.sizes = sizes or tuple(IMAGE_DERIVATIVES['SIZES'])
+        kwargs.update(source='*', read_only=True)
+        super().__init__(**kwargs)
+
+    def _url(self, name):
+        url = default_storage.url(name)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def to_representation(self, recipe):
+        if not recipe.image:
+            return None
+        derivatives = recipe.image_derivatives
+        if derivatives.get('source') != recipe.image.name:
+            derivatives = {}
+        original = self._url(recipe.image.name)
+        return {
+            size: {
+                extension: self._url(derivatives[size][extension])
+                if size in derivatives else original
+                for extension, _ in FORMATS
+            }
+            for size in self.sizes
+        }
@@ -1,27 +1,58 @@
 from django.contrib.auth import get_user_model
+from django.db.models import F
 from django_filters.rest_framework import FilterSet, filters
-from recipes.models import Ingredient, Recipe, Tag
+from recipes.models import Recipe
+from recipes.search import search_recipes
+from recipes.tag_bits import mask_of, slug_bits
 
 User = get_user_model()
 
 
-class IngredientFilter(FilterSet):
-    name = filters.CharFilter(
-        field_name='name',
-        lookup_expr='istartswith'
-    )
+class RecipeOrderingFilter(filters.OrderingFilter):
+    '''Ordering by a counter, newest first among equal values.'''
 
-    class Meta:
+    def filter(self, qs, value):
+        if not value:
+            return qs
+        return qs.order_by(
+            *(self.get_ordering_value(param) for param in value),
+            '-pub_date', '-pk',
+        )
+
+
+class TagMaskFilter(filters.MultipleChoiceFilter):
+    '''Recipes with any of the tags, or with all of them if conjoined.
+
+    Compares the tag bits of Recipe.tag_mask, without a join.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('choices', self.slug_choices)
+        super().__init__(*args, **kwargs)
 
-        model = Ingredient
-        fields = ('name',)
+    @staticmethod
+    def slug_choices():
+        return [(slug, slug) for slug in slug_bits()]
+
+    def filter(self, qs, value):
+        if not value:
+            return qs
+        bits = slug_bits()
+        mask = mask_of(bits[slug] for slug in value)
+        qs = qs.alias(tag_hits=F('tag_mask').bitand(mask))
+        if self.conjoined:
+            return qs.filter(tag_hits=mask)
+        return qs.exclude(tag_hits=0)
 
 
 class RecipeFilter(FilterSet):
-    tags = filters.ModelMultipleChoiceFilter(
-        field_name='tags__slug',
-        to_field_name='slug',
-        queryset=Tag.objects.all(),
+    tags = TagMaskFilter()
+    all_tags = TagMaskFilter(conjoined=True)
+    min_cooking_time = filters.NumberFilter(
+        field_name='cooking_time', lookup_expr='gte',
+    )
+    max_cooking_time = filters.NumberFilter(
+        field_name='cooking_time', lookup_expr='lte',
     )
     is_favorited = filters.BooleanFilter(
         method='filter_is_favorited',
@@ -29,10 +60,23 @@ class RecipeFilter(FilterSet):
     is_in_shopping_cart = filters.BooleanFilter(
         method='filter_is_in_shopping_cart',
     )
+    search = filters.CharFilter(
+        method='filter_search',
+    )
+    ordering = RecipeOrderingFilter(
+        fields=(('favorites_count', 'popularity'), ('pub_date', 'pub_date')),
+    )
 
     class Meta:
         model = Recipe
-        fields = ('author', 'tags', 'is_favorited', 'is_in_shopping_cart')
+        fields = (
+            'author', 'tags', 'all_tags', 'min_cooking_time',
+            'max_cooking_time', 'is_favorited', 'is_in_shopping_cart',
+            'search', 'ordering',
+        )
+
+    def filter_search(self, queryset, name, value):
+        return search_recipes(queryset, value)
 
     def filter_is_in_shopping_cart(self, queryset, name, value):
         if value and self.request.user.is_authenticated:
@@ -0,0 +1,416 @@
+import asyncio
+import statistics
+import tempfile
+import time
+import tracemalloc
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest import mock
+
+from api.fields import SpooledImageField
+from api.seeding import seed, test_database
+from api.views import RecipeViewSet
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.test import RequestFactory, override_settings
+from drf_extra_fields.fields import Base64ImageField
+from foodgram import db
+from foodgram.handlers import ASGIHandler
+from PIL import Image
+from recipes.images import generate_derivatives
+from recipes.models import Ingredient, Recipe, ShoppingListItem
+from rest_framework.test import (APIClient, APIRequestFactory,
+                                 force_authenticate)
+
+
+class Command(BaseCommand):
+    help = 'Runs a benchmark scenario against a seeded test database.'
+
+    scenarios = ('connections', 'export', 'images', 'serving', 'upload')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=self.scenarios)
+        parser.add_argument(
+            '--rows', type=int, nargs='+', default=[1000, 20000],
+            help='shopping list sizes for the export scenario',
+        )
+        parser.add_argument(
+            '--page-size', type=int, default=6,
+            help='recipes per page for the images scenario',
+        )
+        parser.add_argument(
+            '--requests', type=int, default=200,
+            help='requests per URL for the connections scenario, '
+                 'in total for the serving scenario',
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=100,
+            help='clients at a time for the serving scenario',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='WSGI workers for the serving scenario',
+        )
+        parser.add_argument(
+            '--client-delay', type=float, default=20,
+            help='ms a client of the serving scenario takes per body part',
+        )
+
+    def handle(self, *args, **options):
+        with test_database():
+            ctx = seed()
+            client = APIClient()
+            client.credentials(
+                HTTP_AUTHORIZATION=f'Token {ctx["token"].key}'
+            )
+            getattr(self, f'_run_{options["scenario"]}')(
+                client, ctx, options
+            )
+
+    def _run_connections(self, client, ctx, options):
+        '''Time per request and connections opened, old and new setup.
+
+        Requests go through the WSGI handler like under gunicorn, the test
+        client would keep the connection open between requests.
+        '''
+        factory = RequestFactory()
+        headers = {'HTTP_AUTHORIZATION': f'Token {ctx["token"].key}'}
+        urls = (
+            '/api/tags/', '/api/ingredients/', '/api/recipes/?limit=6',
+        )
+        self.stdout.write(
+            f'{"setup":<34}{"url":<24}{"ms":>8}{"connects":>10}'
+        )
+        for name, policy, max_age in (
+            ('atomic requests, no reuse', 'all', 0),
+            ('atomic writes, persistent', 'writes', 60),
+        ):
+            for url in urls:
+                environ = factory.get(url, **headers).environ
+                self._measure_requests(
+                    name, url, environ, policy, max_age, options['requests']
+                )
+        if connection.vendor == 'sqlite':
+            self.stdout.write(
+                'SQLite test databases live in memory and are never '
+                'closed, run on PostgreSQL to see the connection cost.'
+            )
+
+    def _measure_requests(self, name, url, environ, policy, max_age,
+                          requests):
+        handler = WSGIHandler()
+        connects = []
+
+        def count(**kwargs):
+            connects.append(1)
+
+        connection.close()
+        settings = connection.settings_dict
+        saved = settings['ATOMIC_REQUESTS'], settings['CONN_MAX_AGE']
+        settings['ATOMIC_REQUESTS'] = policy == 'all'
+        settings['CONN_MAX_AGE'] = max_age
+        connection_created.connect(count)
+        try:
+            with mock.patch.object(db, 'TRANSACTION_POLICY', policy):
+                started = time.perf_counter()
+                for _ in range(requests):
+                    response = handler(dict(environ), lambda *args: None)
+                    b''.join(response)
+                    # Closing the response finishes the request.
+                    response.close()
+                finished = time.perf_counter()
+        finally:
+            connection_created.disconnect(count)
+            settings['ATOMIC_REQUESTS'], settings['CONN_MAX_AGE'] = saved
+            connection.close()
+
+        self.stdout.write(
+            f'{name:<34}{url:<24}'
+            f'{(finished - started) * 1000 / requests:>8.2f}'
+            f'{len(connects):>10}'
+        )
+
+    def _run_serving(self, client, ctx, options):
+        '''Throughput and latency of WSGI workers and the ASGI handler.
+
+        Both run in this process: the WSGI handler in a pool of threads,
+        one per sync worker, the ASGI handler on one event loop. Clients
+        are slow, they take --client-delay ms to receive each body part.
+        '''
+        headers = {'HTTP_AUTHORIZATION': f'Token {ctx["token"].key}'}
+        paths = (
+            '/api/recipes/?limit=6', f'/api/recipes/{ctx["recipes"][0].id}/',
+            '/api/tags/', '/api/ingredients/',
+            '/api/recipes/download_shopping_cart/',
+        )
+        urls = [
+            paths[number % len(paths)] for number in range(options['requests'])
+        ]
+        delay = options['client_delay'] / 1000
+        factory = RequestFactory()
+        wsgi = WSGIHandler()
+        asgi = ASGIHandler()
+
+        def wsgi_request(url):
+            response = wsgi(
+                factory.get(url, **headers).environ, lambda *args: None
+            )
+            for _ in response:
+                # The sync worker is busy until the client has the part.
+                time.sleep(delay)
+            response.close()
+
+        async def asgi_request(url):
+            path, _, query = url.partition('?')
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                if message.get('body'):
+                    await asyncio.sleep(delay)
+
+            await asgi({
+                'type': 'http', 'asgi': {'version': '3.0'},
+                'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                'path': path, 'query_string': query.encode(),
+                'headers': [(b'authorization', headers[
+                    'HTTP_AUTHORIZATION'
+                ].encode())],
+                'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+            }, receive, send)
+
+        self.stdout.write(
+            f'{"mode":<16}{"requests":>10}{"req/s":>10}{"p50 ms":>10}'
+            f'{"p99 ms":>10}'
+        )
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            loop = asyncio.new_event_loop()
+            try:
+                for name, request in (
+                    (f'wsgi x{options["workers"]}', lambda url: (
+                        loop.run_in_executor(pool, wsgi_request, url)
+                    )),
+                    ('asgi', asgi_request),
+                ):
+                    self._measure_serving(
+                        name, loop, request, urls, options['concurrency']
+                    )
+            finally:
+                loop.close()
+
+    def _measure_serving(self, name, loop, request, urls, concurrency):
+        latencies = []
+
+        async def run():
+            slots = asyncio.Semaphore(concurrency)
+
+            async def client(url):
+                async with slots:
+                    started = time.perf_counter()
+                    await request(url)
+                    latencies.append(time.perf_counter() - started)
+
+            await asyncio.gather(*(client(url) for url in urls))
+
+        started = time.perf_counter()
+        loop.run_until_complete(run())
+        finished = time.perf_counter()
+        percentiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f'{name:<16}{len(urls):>10}'
+            f'{len(urls) / (finished - started):>10.1f}'
+            f'{percentiles[49] * 1000:>10.1f}{percentiles[98] * 1000:>10.1f}'
+        )
+
+    def _run_export(self, client, ctx, options):
+        '''Time to first byte, total time and peak memory of the export.'''
+        reader = ctx['reader']
+        self.stdout.write(
+            f'{"format":<8}{"rows":>8}{"ttfb ms":>10}{"total ms":>10}'
+            f'{"KiB":>9}{"peak KiB":>10}'
+        )
+        for rows in options['rows']:
+            self._fill_shopping_list(reader, rows)
+            for export_format in ('txt', 'csv', 'pdf'):
+                self._measure_export(client, export_format, rows)
+
+    def _fill_shopping_list(self, reader, rows):
+        ShoppingListItem.objects.filter(user=reader).delete()
+        existing = Ingredient.objects.count()
+        if rows > existing:
+            Ingredient.objects.bulk_create(
+                (
+                    Ingredient(name=f'Продукт {number}', measurement_unit='г')
+                    for number in range(existing, rows)
+                ),
+                batch_size=1000,
+            )
+        ShoppingListItem.objects.bulk_create(
+            (
+                ShoppingListItem(
+                    user=reader, ingredient_id=ingredient_id,
+                    amount=number % 500 + 1,
+                )
+                for number, ingredient_id in enumerate(
+                    Ingredient.objects.values_list('id', flat=True)[:rows]
+                )
+            ),
+            batch_size=1000,
+        )
+
+    def _measure_export(self, client, export_format, rows):
+        url = f'/api/recipes/download_shopping_cart/?format={export_format}'
+        tracemalloc.start()
+        started = time.perf_counter()
+        response = client.get(url)
+        content = iter(response.streaming_content)
+        size = len(next(content))
+        first_byte = time.perf_counter()
+        for chunk in content:
+            size += len(chunk)
+        finished = time.perf_counter()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        response.close()
+
+        self.stdout.write(
+            f'{export_format:<8}{rows:>8}'
+            f'{(first_byte - started) * 1000:>10.1f}'
+            f'{(finished - started) * 1000:>10.1f}'
+            f'{size / 1024:>9.0f}{peak / 1024:>10.0f}'
+        )
+
+    def _run_images(self, client, ctx, options):
+        '''Image bytes of a recipe list page, originals against copies.'''
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root):
+                self._measure_images(client, ctx, options['page_size'])
+
+    def _measure_images(self, client, ctx, page_size):
+        photo = self._photo()
+        for recipe in Recipe.objects.all()[:page_size]:
+            # update() does not schedule the background generation.
+            Recipe.objects.filter(pk=recipe.pk).update(
+                image=default_storage.save(
+                    'recipes/image/photo.jpg', ContentFile(photo)
+                )
+            )
+            generate_derivatives(recipe.pk)
+
+        response = client.get(
+            f'/api/recipes/?limit={page_size}',
+            HTTP_HOST='testserver',
+        )
+        media_url = 'http://testserver' + default_storage.base_url
+        results = response.data['results']
+
+        def page_bytes(url_of):
+            return sum(
+                default_storage.size(url_of(recipe)[len(media_url):])
+                for recipe in results if recipe['image']
+            )
+
+        original = page_bytes(lambda recipe: recipe['image'])
+        self.stdout.write(f'{"image":<14}{"KiB per page":>14}{"ratio":>8}')
+        self.stdout.write(f'{"original":<14}{original / 1024:>14.0f}')
+        for extension in ('webp', 'jpeg'):
+            size = page_bytes(
+                lambda recipe: recipe['images']['card'][extension]
+            )
+            self.stdout.write(
+                f'{"card " + extension:<14}{size / 1024:>14.0f}'
+                f'{original / size:>8.1f}'
+            )
+        Recipe.objects.update(image='', image_derivatives={})
+
+    def _run_upload(self, client, ctx, options):
+        '''Peak memory of a recipe image upload, in a field and a request.'''
+        photo = self._photo()
+        encoded = 'data:image/jpeg;base64,' + b64encode(photo).decode()
+        self.stdout.write(
+            f'Image of {len(photo) / 1024:.0f} KiB, '
+            f'{len(encoded) / 1024:.0f} KiB in base64.'
+        )
+        self.stdout.write(f'{"upload":<24}{"ms":>8}{"peak KiB":>10}')
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root):
+                for name, field in (
+                    ('base64 field, old', Base64ImageField()),
+                    ('base64 field', SpooledImageField()),
+                ):
+                    self._measure_upload(
+                        name, lambda: field.run_validation(encoded)
+                    )
+
+                factory = APIRequestFactory()
+                data = {
+                    'ingredients': [
+                        {'id': ctx['ingredients'][0].id, 'amount': 1},
+                    ],
+                    'tags': [ctx['tags'][0].id],
+                    'name': 'Пирог',
+                    'text': 'Испечь.',
+                    'cooking_time': 30,
+                }
+                upload = ContentFile(photo, name='photo.jpg')
+                for name, request in (
+                    ('json request', factory.post(
+                        '/api/recipes/', {**data, 'image': encoded},
+                        format='json',
+                    )),
+                    ('multipart request', factory.post(
+                        '/api/recipes/', {
+                            'ingredients[0]id': ctx['ingredients'][0].id,
+                            'ingredients[0]amount': 1,
+                            'tags': data['tags'],
+                            'name': data['name'],
+                            'text': data['text'],
+                            'cooking_time': data['cooking_time'],
+                            'image': upload,
+                        },
+                        format='multipart',
+                    )),
+                ):
+                    force_authenticate(request, user=ctx['reader'])
+                    self._measure_upload(
+                        name, lambda: self._create_recipe(request)
+                    )
+
+    def _create_recipe(self, request):
+        view = RecipeViewSet.as_view({'post': 'create'})
+        with transaction.atomic():
+            response = view(request)
+            if response.status_code != 201:
+                raise RuntimeError(response.data)
+            transaction.set_rollback(True)
+
+    def _measure_upload(self, name, upload):
+        tracemalloc.start()
+        started = time.perf_counter()
+        upload()
+        finished = time.perf_counter()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(
+            f'{name:<24}{(finished - started) * 1000:>8.1f}'
+            f'{peak / 1024:>10.0f}'
+        )
+
+    def _photo(self):
+        '''A 6 megapixel JPEG with gradients and sensor-like noise.'''
+        size = (3000, 2000)
+        gradient = Image.linear_gradient('L').resize(size)
+        image = Image.merge('RGB', (
+            gradient,
+            Image.effect_noise(size, 12),
+            gradient.rotate(90),
+        ))
+        buffer = BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        return buffer.getvalue()
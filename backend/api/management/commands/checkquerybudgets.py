@@ -0,0 +1,250 @@
+from collections import namedtuple
+from contextlib import ExitStack
+from unittest import mock
+
+from api.authentication import token_cache
+from api.membership import membership_cache
+from api.seeding import seed, test_database
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, reset_queries
+from django.test.utils import CaptureQueriesContext
+from recipes import catalog, images, tag_bits
+from recipes.autocomplete import ingredient_index
+from recipes.models import Recipe
+from rest_framework.test import APIClient
+
+User = get_user_model()
+
+PIXEL = (
+    'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAA'
+    'DUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=='
+)
+
+Check = namedtuple(
+    'Check',
+    (
+        'name', 'method', 'url', 'budget', 'cold_budget', 'data', 'undo',
+        'anonymous',
+    ),
+    defaults=(None, None, False),
+)
+
+# Maximum number of SQL queries per request: budget with the token of the
+# client and the other caches warmed up, cold_budget in a fresh worker with
+# every cache empty. Paginated checks run at two page sizes and must cost
+# the same at both.
+CHECKS = (
+    Check('recipes-list', 'get', '/api/recipes/?limit={limit}', 4, 5),
+    Check(
+        'recipes-list-anonymous', 'get', '/api/recipes/?limit={limit}', 4, 4,
+        anonymous=True,
+    ),
+    Check(
+        'recipes-list-filtered', 'get',
+        '/api/recipes/?limit={limit}&is_favorited=1&tags={tag}'
+        '&min_cooking_time=10', 4, 7,
+    ),
+    Check('recipes-feed', 'get', '/api/recipes/feed/?limit={limit}', 5, 6),
+    Check('recipes-detail', 'get', '/api/recipes/{recipe}/', 3, 4),
+    Check(
+        'recipes-create', 'post', '/api/recipes/', 12, 12,
+        data=lambda ctx: {
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 10}
+                for ingredient in ctx['ingredients'][:5]
+            ],
+            'tags': [ctx['tags'][0].id],
+            'image': PIXEL,
+            'name': 'Новый рецепт',
+            'text': 'Описание',
+            'cooking_time': 15,
+        },
+        undo=('delete', '/api/recipes/{created}/'),
+    ),
+    Check(
+        'recipes-update', 'patch', '/api/recipes/{own_recipe}/', 16, 16,
+        data=lambda ctx: {
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 20}
+                for ingredient in ctx['ingredients'][3:8]
+            ],
+            'tags': [ctx['tags'][1].id],
+            'name': 'Изменённый рецепт',
+            'text': 'Описание',
+            'cooking_time': 20,
+        },
+    ),
+    Check(
+        'favorite', 'post', '/api/recipes/{fresh_recipe}/favorite/', 8, 8,
+        undo=('delete', '/api/recipes/{fresh_recipe}/favorite/'),
+    ),
+    Check(
+        'shopping-cart', 'post',
+        '/api/recipes/{fresh_recipe}/shopping_cart/', 11, 11,
+        undo=('delete', '/api/recipes/{fresh_recipe}/shopping_cart/'),
+    ),
+    Check(
+        'download-shopping-cart', 'get',
+        '/api/recipes/download_shopping_cart/', 1, 2,
+    ),
+    Check('users-list', 'get', '/api/users/?limit={limit}', 2, 3),
+    Check('users-detail', 'get', '/api/users/{stranger}/', 1, 2),
+    Check('users-me', 'get', '/api/users/me/', 0, 1),
+    Check(
+        'subscriptions', 'get',
+        '/api/users/subscriptions/?limit={limit}&recipes_limit={limit}', 3, 4,
+    ),
+    Check(
+        'subscribe', 'post',
+        '/api/users/{stranger}/subscribe/?recipes_limit={limit}', 10, 10,
+        undo=('delete', '/api/users/{stranger}/subscribe/'),
+    ),
+    Check('tags-list', 'get', '/api/tags/', 0, 3),
+    Check('ingredients-list', 'get', '/api/ingredients/?name={prefix}', 0, 3),
+)
+
+
+def prepare_checks():
+    '''Seed the data the checks refer to, return it and two clients.'''
+    ctx = seed()
+    reader = ctx['reader']
+    ctx.update(
+        recipe=ctx['recipes'][0].id,
+        fresh_recipe=ctx['recipes'][1].id,
+        tag=ctx['tags'][0].slug,
+        prefix=ctx['ingredients'][0].name[:4],
+        own_recipe=Recipe.objects.create(
+            author=reader, name='Свой рецепт', text='Описание',
+            cooking_time=5,
+        ).id,
+        stranger=User.objects.create_user(
+            username='stranger', email='stranger@foodgram.ru',
+            password='stranger', first_name='Чужой', last_name='Автор',
+        ).id,
+    )
+
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Token {ctx["token"].key}')
+    anonymous = APIClient()
+    return ctx, client, anonymous
+
+
+def clear_caches():
+    '''Empty the shared and in-process caches, as in a fresh worker.'''
+    for cache in caches.all():
+        cache.clear()
+    catalog.clear()
+    token_cache.clear()
+    membership_cache.clear()
+    ingredient_index.clear()
+    tag_bits.clear()
+
+
+def run_check(client, check, ctx, limit, cold=False):
+    '''Send the request of a check, return the SQL queries it ran.'''
+    url = check.url.format(limit=limit, **ctx)
+    data = check.data(ctx) if check.data else None
+    if cold:
+        clear_caches()
+    elif check.method == 'get':
+        # Measure the steady state, with in-process caches warmed up.
+        client.get(url)
+    reset_queries()
+    with ExitStack() as stack:
+        # Reads may go to the replicas, count the queries of every alias.
+        captures = [
+            stack.enter_context(CaptureQueriesContext(database))
+            for database in connections.all()
+        ]
+        # Image derivatives are made by worker threads on their own
+        # connections, except on SQLite where they would be counted here.
+        stack.enter_context(
+            mock.patch.object(images, 'schedule_derivatives')
+        )
+        response = getattr(client, check.method)(
+            url, data, format='json'
+        )
+        if response.streaming:
+            # Streamed bodies are read from the database as they are sent.
+            b''.join(response.streaming_content)
+
+    if response.status_code >= 400:
+        raise CommandError(
+            f'{check.name}: {check.method.upper()} {url} returned '
+            f'{response.status_code}'
+        )
+
+    # The undo request resets the query log, copy the queries before it.
+    try:
+        return [
+            query for queries in captures
+            for query in queries.captured_queries
+        ]
+    finally:
+        if check.undo:
+            created = response.data.get('id') if check.data else None
+            method, undo_url = check.undo
+            getattr(client, method)(undo_url.format(created=created, **ctx))
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a test database and fails if an API endpoint issues more '
+        'SQL queries than its budget, warm or with empty caches, or if its '
+        'query count grows with the page size.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--small', type=int, default=2, help='small page size'
+        )
+        parser.add_argument(
+            '--large', type=int, default=10, help='large page size'
+        )
+
+    def handle(self, *args, **options):
+        with test_database():
+            failures = self._run_checks(options['small'], options['large'])
+
+        if failures:
+            raise CommandError(
+                'Query budget exceeded: ' + ', '.join(failures)
+            )
+
+        self.stdout.write(self.style.SUCCESS('All query budgets hold.'))
+
+    def _run_checks(self, small, large):
+        ctx, client, anonymous = prepare_checks()
+
+        failures = []
+        for check in CHECKS:
+            check_client = anonymous if check.anonymous else client
+            limits = (small, large) if '{limit}' in check.url else (small,)
+            counts = [
+                len(run_check(check_client, check, ctx, limit))
+                for limit in limits
+            ]
+            cold = len(run_check(check_client, check, ctx, large, cold=True))
+            problems = []
+            if max(counts) > check.budget:
+                problems.append(f'over budget {check.budget}')
+            if cold > check.cold_budget:
+                problems.append(f'cold over budget {check.cold_budget}')
+            if len(set(counts)) > 1:
+                problems.append('grows with page size')
+
+            line = (
+                f'{check.name:<26} {counts[0]:>4} {counts[-1]:>4} '
+                f'/ {check.budget:<4} cold {cold:>4} / {check.cold_budget:<4}'
+            )
+            if not problems:
+                self.stdout.write(f'{line} ok')
+            else:
+                failures.append(check.name)
+                self.stdout.write(self.style.ERROR(
+                    f'{line} {"; ".join(problems)}'
+                ))
+
+        return failures
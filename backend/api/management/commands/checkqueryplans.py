@@ -0,0 +1,172 @@
+import json
+import re
+
+from api.management.commands.checkquerybudgets import (CHECKS, prepare_checks,
+                                                       run_check)
+from api.seeding import seed_volume, test_database
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from recipes.models import (Favorite, FeedEntry, IngredientRecipe, Recipe,
+                            ShoppingListItem, ShoppingСart, TagRecipe)
+from users.models import Follow
+
+User = get_user_model()
+
+# Tables that grow with the users, a full scan of them does not scale.
+LARGE_TABLES = {
+    model._meta.db_table for model in (
+        Recipe, IngredientRecipe, TagRecipe, Favorite, ShoppingСart,
+        ShoppingListItem, FeedEntry, Follow, User,
+    )
+}
+
+TABLE_ALIAS = re.compile(r'(?:FROM|JOIN) "(\w+)"(?: "?(\w+)"?)?')
+STRING = re.compile(r"'(?:[^']|'')*'")
+PARENTHESES = re.compile(r'\([^()]*\)')
+
+# Nodes that pass the rows of their first child on one by one, so a
+# LIMIT above them stops the scan below.
+STREAMING_NODES = {'Limit', 'Nested Loop', 'Result', 'Subquery Scan'}
+
+
+def _is_page_count(sql):
+    '''The total of PageNumberPagination, it counts every row by design.
+
+    ?pagination=cursor caps it, the cursor count has a LIMIT.
+    '''
+    return sql.startswith('SELECT COUNT(*) FROM (') and (
+        ' LIMIT ' not in _top_level(sql)
+    )
+
+
+def _top_level(sql):
+    '''The statement without its strings and parenthesized parts.'''
+    sql = STRING.sub("''", sql)
+    while True:
+        sql, count = PARENTHESES.subn('', sql)
+        if not count:
+            return sql
+
+
+def _postgresql_full_scans(node, limited=False):
+    '''Relations read whole, by the table or by an index.
+
+    An index read without an Index Cond is only bounded when it feeds a
+    LIMIT in index order and filters out nothing.
+    '''
+    kind = node['Node Type']
+    if kind == 'Seq Scan' or (
+        kind in ('Index Scan', 'Index Only Scan')
+        and 'Index Cond' not in node
+        and (not limited or 'Filter' in node)
+    ):
+        yield node['Relation Name']
+    limited = kind == 'Limit' or limited and kind in STREAMING_NODES
+    for number, child in enumerate(node.get('Plans', ())):
+        yield from _postgresql_full_scans(child, limited and not number)
+
+
+def _postgresql_scans(cursor, sql, params):
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return set(_postgresql_full_scans(plan[0]['Plan']))
+
+
+def _sqlite_scans(cursor, sql, params):
+    aliases = {
+        alias or table: table for table, alias in TABLE_ALIAS.findall(sql)
+    }
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    rows = cursor.fetchall()
+    # SEARCH reads the rows of an index condition, SCAN reads everything
+    # unless it is the outer loop of a LIMIT in index order without a
+    # WHERE.
+    top_level = _top_level(sql)
+    ordered = (
+        ' WHERE ' not in top_level and ' LIMIT ' in top_level
+        and not any('TEMP B-TREE' in detail for *_, detail in rows)
+    )
+    scans = set()
+    for number, (_, parent, _, detail) in enumerate(rows):
+        if not detail.startswith('SCAN '):
+            continue
+        if ordered and number == 0 and not parent and ' INDEX ' in detail:
+            continue
+        name = detail.split()[1]
+        scans.add(aliases.get(name, name))
+    return scans
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a test database, runs EXPLAIN on the SELECT queries of every '
+        'API endpoint and fails if one reads a whole large table or index.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=2000,
+            help='users added to the test data, 5 recipes each',
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'postgresql':
+            scans = _postgresql_scans
+        elif connection.vendor == 'sqlite':
+            scans = _sqlite_scans
+        else:
+            raise CommandError(
+                f'EXPLAIN is not supported on {connection.vendor}.'
+            )
+
+        with test_database():
+            failures = self._run_checks(scans, options['users'])
+
+        if failures:
+            raise CommandError(
+                'Full scans of large tables: ' + ', '.join(failures)
+            )
+
+        self.stdout.write(self.style.SUCCESS('No full scans found.'))
+
+    def _run_checks(self, scans, users):
+        ctx, client, anonymous = prepare_checks()
+        seed_volume(users)
+        with connection.cursor() as cursor:
+            # Planner statistics of the seeded tables.
+            cursor.execute('ANALYZE')
+        failures = []
+        for check in CHECKS:
+            queries = run_check(
+                anonymous if check.anonymous else client, check, ctx, 10
+            )
+            selects = {
+                query['sql'] for query in queries
+                if query['sql'].startswith('SELECT')
+                and not _is_page_count(query['sql'])
+            }
+            tables = set()
+            with connection.cursor() as cursor:
+                for sql in selects:
+                    tables.update(self._explain(cursor, scans, sql))
+
+            tables &= LARGE_TABLES
+            line = f'{check.name:<26} {len(selects):>4} selects'
+            if not tables:
+                self.stdout.write(f'{line} ok')
+            else:
+                failures.append(check.name)
+                self.stdout.write(self.style.ERROR(
+                    f'{line} scan {", ".join(sorted(tables))}'
+                ))
+        return failures
+
+    def _explain(self, cursor, scans, sql):
+        '''Explain a logged query, its parameters are already inlined.'''
+        try:
+            return scans(cursor, sql, None)
+        except Exception as error:
+            raise CommandError(f'Cannot explain {sql}: {error}')
@@ -0,0 +1,256 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from foodgram.settings import MEMBERSHIP_CACHE
+from recipes.models import Favorite, ShoppingСart
+from users.models import Follow
+
+FAVORITES = 'favorites'
+SHOPPING_CART = 'shopping_cart'
+FOLLOWING = 'following'
+
+# kind -> (model, owner field, member field)
+SOURCES = {
+    FAVORITES: (Favorite, 'user_id', 'recipe_id'),
+    SHOPPING_CART: (ShoppingСart, 'user_id', 'recipe_id'),
+    FOLLOWING: (Follow, 'user_id', 'author_id'),
+}
+
+
+class _Entry:
+
+    __slots__ = ('ids', 'version', 'expires')
+
+    def __init__(self, ids, version, expires):
+        self.ids = ids
+        self.version = version
+        self.expires = expires
+
+
+class MembershipCache:
+    '''Per-user sets of favorite recipes, cart recipes and followed authors.
+
+    Sets are kept in a process-local LRU as sorted arrays of 64-bit ints
+    and updated in place after the writing transaction commits. ALIAS
+    must name a cache shared by all processes (memcached): each user has
+    a version there that every write bumps, so other processes reload the
+    set on their next read. Without ALIAS nothing is kept between
+    requests, views annotate the flags instead (see shared).
+    '''
+
+    def __init__(self, alias=None, max_users=10000, ttl=60):
+        self.alias = alias
+        self.max_entries = max_users * len(SOURCES)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def _shared(self):
+        return caches[self.alias] if self.alias else None
+
+    @property
+    def shared(self):
+        '''Whether the sets are kept, other workers see the writes.'''
+        return self.alias is not None
+
+    def _version_key(self, user_id):
+        return f'membership:version:{user_id}'
+
+    def _get_version(self, user_id):
+        if self._shared is None:
+            return None
+        return self._shared.get(self._version_key(user_id), 0)
+
+    def _bump_version(self, user_id):
+        '''Return the new version, or None if another process wrote too.'''
+        if self._shared is None:
+            return None
+        key = self._version_key(user_id)
+        self._shared.add(key, 0, timeout=None)
+        try:
+            return self._shared.incr(key)
+        except ValueError:
+            return None
+
+    def _load(self, kind, user_id):
+        model, owner, member = SOURCES[kind]
+        return array('q', sorted(
+            model.objects.filter(**{owner: user_id}).values_list(
+                member, flat=True
+            )
+        ))
+
+    def get(self, kind, user_id):
+        '''Return the sorted array of member ids of the user.'''
+        if not self.shared:
+            return self._load(kind, user_id)
+
+        key = (kind, user_id)
+        version = self._get_version(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry.version == version
+                and entry.expires > time.monotonic()
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.ids
+            self.misses += 1
+
+        ids = self._load(kind, user_id)
+        with self._lock:
+            self._entries[key] = _Entry(
+                ids, version, time.monotonic() + self.ttl
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return ids
+
+    def _write(self, kind, user_id, member_id, add):
+        key = (kind, user_id)
+        old_version = self._get_version(user_id)
+        new_version = self._bump_version(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if (
+                old_version is not None
+                and (new_version is None or new_version != old_version + 1)
+            ):
+                del self._entries[key]
+                return
+            position = bisect_left(entry.ids, member_id)
+            present = (
+                position < len(entry.ids)
+                and entry.ids[position] == member_id
+            )
+            if add and not present:
+                insort(entry.ids, member_id)
+            elif not add and present:
+                del entry.ids[position]
+            entry.version = new_version
+
+    def add(self, kind, user_id, member_id):
+        self._write(kind, user_id, member_id, add=True)
+
+    def discard(self, kind, user_id, member_id):
+        self._write(kind, user_id, member_id, add=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def for_user(self, user):
+        return UserMemberships(self, user)
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            hits, misses = self.hits, self.misses
+        requests = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / requests if requests else None,
+            'entries': len(entries),
+            'bytes': sum(
+                entry.ids.buffer_info()[1] * entry.ids.itemsize
+                for entry in entries
+            ),
+        }
+
+
+class UserMemberships:
+    '''Membership lookups of one user, each set fetched once per request.'''
+
+    def __init__(self, cache, user):
+        self.cache = cache
+        self.user_id = user.pk if user.is_authenticated else None
+        self._sets = {}
+
+    def contains(self, kind, member_id):
+        if self.user_id is None:
+            return False
+        if kind not in self._sets:
+            self._sets[kind] = self.cache.get(kind, self.user_id)
+        ids = self._sets[kind]
+        position = bisect_left(ids, member_id)
+        return position < len(ids) and ids[position] == member_id
+
+    def is_favorited(self, recipe_id):
+        return self.contains(FAVORITES, recipe_id)
+
+    def is_in_shopping_cart(self, recipe_id):
+        return self.contains(SHOPPING_CART, recipe_id)
+
+    def is_subscribed(self, author_id):
+        return self.contains(FOLLOWING, author_id)
+
+
+membership_cache = MembershipCache(
+    alias=MEMBERSHIP_CACHE['ALIAS'],
+    max_users=MEMBERSHIP_CACHE['MAX_USERS'],
+    ttl=MEMBERSHIP_CACHE['TTL'],
+)
+
+
+def get_memberships(context):
+    '''Memberships of the requesting user for a serializer context.
+
+    Views put them in the context; a serializer used without one creates
+    them once and shares them with every nested serializer.
+    '''
+    if 'memberships' not in context:
+        request = context.get('request')
+        context['memberships'] = membership_cache.for_user(
+            request.user if request is not None else AnonymousUser()
+        )
+    return context['memberships']
+
+
+def _make_receivers(kind):
+    _, owner, member = SOURCES[kind]
+
+    def saved(sender, instance, created, **kwargs):
+        if created:
+            user_id = getattr(instance, owner)
+            member_id = getattr(instance, member)
+            transaction.on_commit(
+                lambda: membership_cache.add(kind, user_id, member_id)
+            )
+
+    def deleted(sender, instance, **kwargs):
+        user_id = getattr(instance, owner)
+        member_id = getattr(instance, member)
+        transaction.on_commit(
+            lambda: membership_cache.discard(kind, user_id, member_id)
+        )
+
+    return saved, deleted
+
+
+def connect_signals():
+    for kind, (model, _, _) in SOURCES.items():
+        saved, deleted = _make_receivers(kind)
+        post_save.connect(
+            saved, sender=model, weak=False,
+            dispatch_uid=f'membership_{kind}_saved',
+        )
+        post_delete.connect(
+            deleted, sender=model, weak=False,
+            dispatch_uid=f'membership_{kind}_deleted',
+        )
@@ -0,0 +1,112 @@
+import gzip
+from hashlib import sha1
+
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from foodgram.settings import CATALOG_CACHE
+from recipes.catalog import get_catalog_version
+from rest_framework.renderers import JSONRenderer
+
+
+def accepts_gzip(accept_encoding):
+    '''Whether an Accept-Encoding header allows gzip (q-value above 0).'''
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, *params = (part.strip() for part in item.split(';'))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+class CatalogCacheMixin:
+    '''HTTP caching for read-only catalog viewsets.
+
+    Rendered JSON bodies of requests without a query string are stored in
+    the cache together with a gzipped copy, keyed by the catalog version
+    and the path, so the number of entries is bounded by the catalog.
+    Filtered requests are rendered every time. All responses carry strong
+    ETags, Last-Modified and Cache-Control, and conditional requests are
+    answered with 304 Not Modified.
+    '''
+    catalog_max_age = CATALOG_CACHE['MAX_AGE']
+    catalog_timeout = CATALOG_CACHE['TIMEOUT']
+
+    def list(self, request, *args, **kwargs):
+        return self._catalog_response(
+            request, lambda: super(CatalogCacheMixin, self).list(
+                request, *args, **kwargs
+            )
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._catalog_response(
+            request, lambda: super(CatalogCacheMixin, self).retrieve(
+                request, *args, **kwargs
+            )
+        )
+
+    def _catalog_response(self, request, get_response):
+        version = get_catalog_version()
+        digest = sha1(
+            f'{version}:{request.get_full_path()}'.encode()
+        ).hexdigest()
+        use_gzip = accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        etag = f'"{digest}-gzip"' if use_gzip else f'"{digest}"'
+        last_modified = version // 10 ** 9
+
+        if self._not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(
+                self._catalog_body(request, digest, use_gzip, get_response),
+                content_type='application/json',
+            )
+            if use_gzip:
+                response['Content-Encoding'] = 'gzip'
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = f'public, max-age={self.catalog_max_age}'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def _catalog_body(self, request, digest, use_gzip, get_response):
+        if request.META.get('QUERY_STRING'):
+            content = JSONRenderer().render(get_response().data)
+            return gzip.compress(content) if use_gzip else content
+
+        key = f'catalog:body:{digest}'
+        bodies = cache.get(key)
+        if bodies is None:
+            content = JSONRenderer().render(get_response().data)
+            bodies = (content, gzip.compress(content))
+            cache.set(key, bodies, timeout=self.catalog_timeout)
+        return bodies[1] if use_gzip else bodies[0]
+
+    def _not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            etags = parse_etags(if_none_match)
+            return etag in etags or '*' in etags
+
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', '')
+        )
+        return (
+            if_modified_since is not None
+            and last_modified <= if_modified_since
+        )
@@ -1,7 +1,82 @@
-from rest_framework.pagination import PageNumberPagination
+from collections import OrderedDict
+
+from foodgram.settings import PAGINATION_COUNT_CAP
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
 
 
 class CustomPagination(PageNumberPagination):
     '''Limit on displaying posts per page.'''
     page_size = 6
     page_size_query_param = 'limit'
+
+
+class CappedCountCursorPagination(CursorPagination):
+    '''Keyset pagination whose total count stops at PAGINATION_COUNT_CAP.
+
+    Page cost does not depend on the page depth, and the count query
+    reads at most count_cap + 1 rows whatever the table size.
+    '''
+    page_size = 6
+    page_size_query_param = 'limit'
+    count_cap = PAGINATION_COUNT_CAP
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = queryset.order_by()[:self.count_cap + 1].count()
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', min(self.count, self.count_cap)),
+            ('count_capped', self.count > self.count_cap),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+
+class RecipeCursorPagination(CappedCountCursorPagination):
+    ordering = ('-pub_date', 'id')
+
+
+class FeedCursorPagination(CappedCountCursorPagination):
+    ordering = ('-feed_date', 'feed_recipe')
+
+
+class SubscriptionCursorPagination(CappedCountCursorPagination):
+    ordering = ('created', 'id')
+
+
+class OptionalCursorPaginationMixin:
+    '''Switch a view to cursor pagination with ?pagination=cursor.
+
+    Follow-up pages carry the cursor parameter and stay in cursor mode.
+    The cursor ordering is fixed, parameters in cursor_conflicting_params
+    that order the results differently are refused in cursor mode.
+    '''
+    cursor_pagination_classes = {}
+    cursor_conflicting_params = ()
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            cursor_class = self.cursor_pagination_classes.get(self.action)
+            if cursor_class is not None and (
+                params.get('pagination') == 'cursor'
+                or cursor_class.cursor_query_param in params
+            ):
+                conflicts = [
+                    param for param in self.cursor_conflicting_params
+                    if params.get(param)
+                ]
+                if conflicts:
+                    raise ValidationError({
+                        param: ['Not supported with cursor pagination.']
+                        for param in conflicts
+                    })
+                self._paginator = cursor_class()
+            else:
+                self._paginator = super().paginator
+        return self._paginator
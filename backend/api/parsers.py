@@ -0,0 +1,50 @@
+from io import BytesIO
+
+from foodgram.settings import IMAGE_UPLOAD
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.parsers import JSONParser, MultiPartParser
+
+# A base64 image takes 4/3 of its size.
+MAX_BODY_BYTES = (
+    IMAGE_UPLOAD['MAX_BYTES'] * 4 // 3 + IMAGE_UPLOAD['MAX_BODY_OVERHEAD']
+)
+
+
+class RequestTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'The request body is too large.'
+    default_code = 'request_too_large'
+
+
+def _check_content_length(parser_context):
+    request = (parser_context or {}).get('request')
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except (AttributeError, ValueError):
+        length = 0
+    if length > MAX_BODY_BYTES:
+        raise RequestTooLarge()
+
+
+class BoundedJSONParser(JSONParser):
+    '''JSONParser refusing bodies that cannot hold a valid recipe.
+
+    The declared length is checked before reading, a body without one is
+    read no further than the limit.
+    '''
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        _check_content_length(parser_context)
+        body = stream.read(MAX_BODY_BYTES + 1) if stream else b''
+        if len(body) > MAX_BODY_BYTES:
+            raise RequestTooLarge()
+        return super().parse(BytesIO(body), media_type, parser_context)
+
+
+class BoundedMultiPartParser(MultiPartParser):
+    '''MultiPartParser with the same limit, files are spooled to disk.'''
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        _check_content_length(parser_context)
+        return super().parse(stream, media_type, parser_context)
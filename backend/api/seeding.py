@@ -0,0 +1,200 @@
+from contextlib import contextmanager
+from string import ascii_lowercase
+
+from django.contrib.auth import get_user_model
+from django.db import connection, connections
+from foodgram.db import replica_aliases
+from recipes import counters, feed, shopping_list, tag_bits
+from recipes.models import (Favorite, Ingredient, IngredientRecipe, Recipe,
+                            ShoppingСart, Tag, TagRecipe)
+from rest_framework.authtoken.models import Token
+from users.models import Follow
+
+User = get_user_model()
+
+LETTERS = 'абвгдежзиклмнопрстуфхцчшэюя'
+
+
+@contextmanager
+def test_database():
+    '''Run the block against a freshly created and migrated test database.
+
+    The replicas are pointed at it too.
+    '''
+    old_name = connection.settings_dict['NAME']
+    replica_names = {
+        alias: connections[alias].settings_dict['NAME']
+        for alias in replica_aliases()
+    }
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    for alias in replica_names:
+        connections[alias].close()
+        connections[alias].creation.set_as_test_mirror(
+            connection.settings_dict
+        )
+    try:
+        yield
+    finally:
+        for alias, name in replica_names.items():
+            connections[alias].close()
+            connections[alias].settings_dict['NAME'] = name
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def _word(number, letters=LETTERS):
+    '''Letters-only name, the validators do not allow digits.'''
+    word = ''
+    while True:
+        number, rest = divmod(number, len(letters))
+        word = letters[rest] + word
+        if not number:
+            return word
+
+
+def seed(authors=12, recipes_per_author=4, ingredients=30, tags=3,
+         ingredients_per_recipe=5):
+    '''Create a realistic data set and return the reading user and token.
+
+    The reader follows every author, has every other recipe in favorites
+    and every third recipe in the shopping cart.
+    '''
+    Tag.objects.bulk_create(
+        Tag(
+            name=f'Тег {_word(i)}',
+            color=f'#{i:06x}',
+            slug=f'tag-{i}',
+            bit=i,
+        )
+        for i in range(tags)
+    )
+    tag_objs = list(Tag.objects.all())
+    Ingredient.objects.bulk_create(
+        Ingredient(name=f'Ингредиент {_word(i)}', measurement_unit='г')
+        for i in range(ingredients)
+    )
+    ingredient_objs = list(Ingredient.objects.all())
+
+    reader = User.objects.create_user(
+        username='reader', email='reader@foodgram.ru', password='reader',
+        first_name='Читатель', last_name='Читатель',
+    )
+    recipes = []
+    for i in range(authors):
+        author = User.objects.create_user(
+            username=f'author_{_word(i, ascii_lowercase)}',
+            email=f'author{i}@foodgram.ru', password='author',
+            first_name='Автор', last_name=_word(i),
+        )
+        Follow.objects.create(user=reader, author=author)
+        for j in range(recipes_per_author):
+            recipes.append(Recipe.objects.create(
+                author=author, name=f'Рецепт {_word(i)} {_word(j)}',
+                text='Описание рецепта', cooking_time=10 + j,
+            ))
+
+    IngredientRecipe.objects.bulk_create(
+        IngredientRecipe(
+            recipe=recipe,
+            ingredient=ingredient_objs[
+                (number + k) % len(ingredient_objs)
+            ],
+            amount=k + 1,
+        )
+        for number, recipe in enumerate(recipes)
+        for k in range(ingredients_per_recipe)
+    )
+    TagRecipe.objects.bulk_create(
+        TagRecipe(recipe=recipe, tag=tag_objs[number % len(tag_objs)])
+        for number, recipe in enumerate(recipes)
+    )
+    tag_bits.update_masks()
+    Favorite.objects.bulk_create(
+        Favorite(user=reader, recipe=recipe) for recipe in recipes[::2]
+    )
+    ShoppingСart.objects.bulk_create(
+        ShoppingСart(user=reader, recipe=recipe) for recipe in recipes[::3]
+    )
+    shopping_list.rebuild([reader.id])
+    counters.recompute(('favorites_count', 'carts_count'))
+
+    return {
+        'reader': reader,
+        'token': Token.objects.create(user=reader),
+        'recipes': recipes,
+        'tags': tag_objs,
+        'ingredients': ingredient_objs,
+    }
+
+
+def seed_volume(users=2000, recipes_per_user=5):
+    '''Add rows of other users so the tables have a realistic size.
+
+    The planner picks an index only when it reads fewer rows than a full
+    scan would, on the few rows of seed() it scans every table. Each user
+    follows three others, has three favorites and two recipes in the cart.
+    '''
+    tag_objs = list(Tag.objects.all())
+    ingredient_objs = list(Ingredient.objects.all())
+    first_id = User.objects.order_by('-pk').values_list('pk', flat=True)[0]
+    User.objects.bulk_create(
+        User(
+            username=f'user_{_word(i, ascii_lowercase)}',
+            email=f'user{i}@foodgram.ru', password='!',
+            first_name='Пользователь', last_name=_word(i),
+        )
+        for i in range(users)
+    )
+    user_ids = list(User.objects.filter(
+        pk__gt=first_id
+    ).order_by('pk').values_list('pk', flat=True))
+    Recipe.objects.bulk_create(
+        Recipe(
+            author_id=user_id, name=f'Блюдо {_word(j)}',
+            text='Описание рецепта', cooking_time=5 + j,
+        )
+        for user_id in user_ids for j in range(recipes_per_user)
+    )
+    recipe_ids = list(Recipe.objects.filter(
+        author_id__in=user_ids
+    ).order_by('pk').values_list('pk', flat=True))
+
+    IngredientRecipe.objects.bulk_create(
+        IngredientRecipe(
+            recipe_id=recipe_id,
+            ingredient=ingredient_objs[(number + k) % len(ingredient_objs)],
+            amount=k + 1,
+        )
+        for number, recipe_id in enumerate(recipe_ids) for k in range(2)
+    )
+    TagRecipe.objects.bulk_create(
+        TagRecipe(recipe_id=recipe_id, tag=tag_objs[number % len(tag_objs)])
+        for number, recipe_id in enumerate(recipe_ids)
+    )
+    tag_bits.update_masks(recipe_ids)
+
+    def others(number, count):
+        return (
+            user_ids[(number + k) % len(user_ids)]
+            for k in range(1, count + 1)
+        )
+
+    Follow.objects.bulk_create(
+        Follow(user_id=user_id, author_id=author_id)
+        for number, user_id in enumerate(user_ids)
+        for author_id in others(number, 3)
+    )
+    Favorite.objects.bulk_create(
+        Favorite(user_id=user_id, recipe_id=recipe_ids[
+            (number * 7 + k) % len(recipe_ids)
+        ])
+        for number, user_id in enumerate(user_ids) for k in range(3)
+    )
+    ShoppingСart.objects.bulk_create(
+        ShoppingСart(user_id=user_id, recipe_id=recipe_ids[
+            (number * 11 + k) % len(recipe_ids)
+        ])
+        for number, user_id in enumerate(user_ids) for k in range(2)
+    )
+    shopping_list.rebuild(user_ids)
+    counters.recompute()
+    feed.rebuild(user_ids)
@@ -1,14 +1,17 @@
+from api.fields import (BulkPrimaryKeyRelatedField, ImageDerivativesField,
+                        SpooledImageField)
+from api.membership import get_memberships
 from django.contrib.auth import get_user_model
-from django.core.exceptions import BadRequest
 from djoser.serializers import UserCreateSerializer as BaseUserCreateSerializer
 from djoser.serializers import UserSerializer as BaseUserSerializer
 from drf_extra_fields.fields import Base64ImageField
-from recipes.models import Favorite as FavoriteModel
+from recipes import shopping_list
 from recipes.models import Ingredient as IngredientModel
 from recipes.models import IngredientRecipe as IngredientRecipeModel
 from recipes.models import Recipe as RecipeModel
-from recipes.models import ShoppingСart as ShoppingСartModel
 from recipes.models import Tag as TagModel
+from recipes.models import TagRecipe as TagRecipeModel
+from recipes.tag_bits import mask_of
 from recipes.validators import validate_name as validate_tagname
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
@@ -96,11 +99,9 @@ class UserWSubscriptionSerializer(UserSerializer):
         )
 
     def get_is_subscribed(self, instance):
-        request = self.context.get('request')
-        if request.user.is_anonymous:
-            return False
-
-        return instance.following.filter(user=request.user).exists()
+        if hasattr(instance, 'is_subscribed'):
+            return instance.is_subscribed
+        return get_memberships(self.context).is_subscribed(instance.pk)
 
 
 class DummyUserSerializer(serializers.Serializer):
@@ -153,31 +154,31 @@ class RecipeReadSerializer(serializers.ModelSerializer):
         source='ingredientrecipes', many=True
     )
     image = Base64ImageField(read_only=True)
+    images = ImageDerivativesField()
 
     class Meta:
         model = RecipeModel
         fields = (
             'id', 'tags', 'author', 'ingredients', 'is_favorited',
-            'is_in_shopping_cart', 'name', 'image', 'text', 'cooking_time',
+            'is_in_shopping_cart', 'name', 'image', 'images', 'text',
+            'cooking_time',
         )
 
-    def get_is_in_shopping_cart(self, instance):
-        request = self.context.get('request')
-        if request.user.is_anonymous:
-            return False
+    def to_representation(self, instance):
+        if hasattr(instance, 'author_is_subscribed') and instance.author:
+            # The author serializer reads the flag from the author.
+            instance.author.is_subscribed = instance.author_is_subscribed
+        return super().to_representation(instance)
 
-        return ShoppingСartModel.objects.filter(
-            user=request.user, recipe=instance
-        ).exists()
+    def get_is_in_shopping_cart(self, instance):
+        if hasattr(instance, 'is_in_shopping_cart'):
+            return instance.is_in_shopping_cart
+        return get_memberships(self.context).is_in_shopping_cart(instance.pk)
 
     def get_is_favorited(self, instance):
-        request = self.context.get('request')
-        if request.user.is_anonymous:
-            return False
-
-        return FavoriteModel.objects.filter(
-            user=request.user, recipe=instance
-        ).exists()
+        if hasattr(instance, 'is_favorited'):
+            return instance.is_favorited
+        return get_memberships(self.context).is_favorited(instance.pk)
 
 
 class IngredientInRecipeWriteSerializer(serializers.Serializer):
@@ -188,21 +189,15 @@ class IngredientInRecipeWriteSerializer(serializers.Serializer):
     class Meta:
         fields = ('id', 'amount')
 
-    def validate_id(self, id_value):
-        if not IngredientModel.objects.filter(pk=id_value).exists():
-            raise ValidationError('Specified ingredient does not exists')
-
-        return id_value
-
 
 class RecipeWriteSerializer(serializers.ModelSerializer):
 
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = BulkPrimaryKeyRelatedField(
         queryset=TagModel.objects.all(), many=True
     )
     ingredients = IngredientInRecipeWriteSerializer(many=True)
     cooking_time = serializers.IntegerField(min_value=1)
-    image = Base64ImageField()
+    image = SpooledImageField()
     name = serializers.CharField(max_length=200)
 
     class Meta:
@@ -216,6 +211,15 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
         validate_name(value)
         return value
 
+    def save(self, **kwargs):
+        try:
+            return super().save(**kwargs)
+        finally:
+            # The storage may have moved the spooled file away already.
+            image = self.validated_data.get('image')
+            if image is not None:
+                image.close()
+
     def validate_ingredients(self, value):
         if not value:
             raise ValidationError('Must have at least one ingredient.')
@@ -224,6 +228,16 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
         if len(set(ids)) != len(ids):
             raise ValidationError('Ingredients must be unique.')
 
+        existing = set(IngredientModel.objects.filter(pk__in=ids).values_list(
+            'pk', flat=True
+        ))
+        if not existing.issuperset(ids):
+            raise ValidationError([
+                {} if pk in existing
+                else {'id': ['Specified ingredient does not exists']}
+                for pk in ids
+            ])
+
         return value
 
     def create(self, validated_data):
@@ -234,52 +248,112 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
 
         recipe = RecipeModel.objects.create(
             author=request.user,
+            tag_mask=mask_of(tag.bit for tag in tags),
             **validated_data
         )
 
-        for ingr_def in ingredients:
-            recipe.ingredientrecipes.create(
-                ingredient_id=ingr_def['id'],
+        IngredientRecipeModel.objects.bulk_create(
+            IngredientRecipeModel(
                 recipe=recipe,
-                amount=ingr_def['amount']
+                ingredient_id=ingr_def['id'],
+                amount=ingr_def['amount'],
             )
-
-        recipe.tags.set(tags)
+            for ingr_def in ingredients
+        )
+        TagRecipeModel.objects.bulk_create(
+            TagRecipeModel(recipe=recipe, tag=tag)
+            for tag in dict.fromkeys(tags)
+        )
         return recipe
 
     def update(self, instance, validated_data):
-        ingredients = validated_data.pop('ingredients')
-        tags = validated_data.pop('tags')
+        ingredients = validated_data.pop('ingredients', None)
+        tags = validated_data.pop('tags', None)
 
         for key, value in validated_data.items():
             setattr(instance, key, value)
 
-        instance.tags.set(tags)
-        instance.ingredientrecipes.all().delete()
-        for ingr_def in ingredients:
-            instance.ingredientrecipes.create(
-                ingredient_id=ingr_def['id'],
-                recipe=instance,
-                amount=ingr_def['amount']
-            )
+        if tags is not None:
+            self._update_tags(instance, tags)
+            instance.tag_mask = mask_of(tag.bit for tag in tags)
+        if ingredients is not None:
+            self._update_ingredients(instance, {
+                ingr_def['id']: ingr_def['amount'] for ingr_def in ingredients
+            })
 
         instance.save()
         return instance
 
+    def _update_tags(self, instance, tags):
+        '''Delete and insert only the tags that changed.'''
+        current = set(TagRecipeModel.objects.filter(
+            recipe=instance
+        ).values_list('tag_id', flat=True))
+        new = {tag.pk for tag in tags}
+        if current - new:
+            TagRecipeModel.objects.filter(
+                recipe=instance, tag_id__in=current - new
+            ).delete()
+        if new - current:
+            TagRecipeModel.objects.bulk_create(
+                TagRecipeModel(recipe=instance, tag_id=tag_id)
+                for tag_id in new - current
+            )
+
+    def _update_ingredients(self, instance, amounts):
+        '''Delete, update and insert only the ingredients that changed.'''
+        current = {
+            row.ingredient_id: row
+            for row in IngredientRecipeModel.objects.filter(
+                recipe=instance
+            ).only('id', 'ingredient_id', 'amount')
+        }
+        old_amounts = {
+            ingredient_id: row.amount for ingredient_id, row in current.items()
+        }
+
+        removed = [
+            row.pk for ingredient_id, row in current.items()
+            if ingredient_id not in amounts
+        ]
+        if removed:
+            IngredientRecipeModel.objects.filter(pk__in=removed).delete()
+
+        changed = []
+        for ingredient_id, row in current.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and amount != row.amount:
+                row.amount = amount
+                changed.append(row)
+        if changed:
+            IngredientRecipeModel.objects.bulk_update(changed, ['amount'])
+
+        IngredientRecipeModel.objects.bulk_create(
+            IngredientRecipeModel(
+                recipe=instance, ingredient_id=ingredient_id, amount=amount,
+            )
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id not in current
+        )
+        shopping_list.apply_recipe_change(instance.pk, old_amounts, amounts)
+
 
 class RecipeSimpleSerializer(serializers.ModelSerializer):
+    images = ImageDerivativesField(sizes=('small',))
 
     class Meta:
         model = RecipeModel
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'images', 'cooking_time')
 
 
 class UserWithRecipesSerializer(UserSerializer):
+    '''Author card of the subscriptions.
+
+    Expects the latest_recipes prefetch made by UserViewSet.
+    '''
 
     recipes = serializers.SerializerMethodField(read_only=True)
-    recipes_count = serializers.IntegerField(
-        source='recipes.count', read_only=True
-    )
+    recipes_count = serializers.IntegerField(read_only=True)
 
     class Meta(UserSerializer.Meta):
         fields = UserSerializer.Meta.fields + (
@@ -288,21 +362,7 @@ class UserWithRecipesSerializer(UserSerializer):
         )
 
     def get_recipes(self, instance):
-
-        recipes_limit = self.context.get('recipes_limit', None)
-        try:
-            if recipes_limit is not None:
-                recipes_limit = int(recipes_limit)
-        except ValueError:
-            raise BadRequest(
-                'Invalid request. Must be a number.'
-            )
-
-        queryset = instance.recipes.order_by('-pub_date')
-        rv = queryset.all()
-
-        if recipes_limit is not None:
-            rv = rv[:recipes_limit]
-
-        serializer = RecipeSimpleSerializer(instance=rv, many=True)
+        serializer = RecipeSimpleSerializer(
+            instance=instance.latest_recipes, many=True
+        )
         return serializer.data
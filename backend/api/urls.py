@@ -1,4 +1,6 @@
-from api.views import IngredientViewSet, RecipeViewSet, TagViewSet, UserViewSet
+from api.views import (CacheStatsView, IngredientViewSet, RecipeImportView,
+                       RecipeViewSet, TagViewSet, UserViewSet)
+from django.db import transaction
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
@@ -11,6 +13,12 @@ router.register('ingredients', IngredientViewSet, 'ingredients')
 router.register('recipes', RecipeViewSet, 'recipes')
 
 urlpatterns = [
+    path('cache-stats/', CacheStatsView.as_view(), name='cache-stats'),
+    path(
+        'recipes/import/',
+        transaction.non_atomic_requests(RecipeImportView.as_view()),
+        name='recipes-import',
+    ),
     path('', include(router.urls)),
     path('', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
@@ -1,5 +1,16 @@
-from api.filters import IngredientFilter, RecipeFilter
-from api.paginations import CustomPagination
+from itertools import islice
+
+from api.authentication import token_cache
+from api.exports import (CsvExportRenderer, ExportFormatNegotiation,
+                         PdfExportRenderer, TxtExportRenderer)
+from api.filters import RecipeFilter
+from api.membership import membership_cache
+from api.mixins import CatalogCacheMixin
+from api.paginations import (CustomPagination, FeedCursorPagination,
+                             OptionalCursorPaginationMixin,
+                             RecipeCursorPagination,
+                             SubscriptionCursorPagination)
+from api.parsers import BoundedJSONParser, BoundedMultiPartParser
 from api.permissions import IsAuthorOrAdminOrReadOnly
 from api.serializers import (DummyUserSerializer, IngredientSerializer,
                              RecipeReadSerializer, RecipeSimpleSerializer,
@@ -8,38 +19,93 @@ from api.serializers import (DummyUserSerializer, IngredientSerializer,
                              UserWithRecipesSerializer,
                              UserWSubscriptionSerializer)
 from django.contrib.auth import get_user_model
-from django.db.models import F, Sum
-from django.http import HttpResponse
+from django.core.exceptions import BadRequest
+from django.db.models import (Exists, F, OuterRef, Prefetch, Value,
+                              prefetch_related_objects)
+from django.http import StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet as BaseUserViewSet
+from foodgram.db import query_counts
+from foodgram.settings import RECIPE_IMPORT
+from recipes.autocomplete import ingredient_index
+from recipes.feed import recipes_for
+from recipes.importer import RecipeImporter
 from recipes.models import Favorite as FavoriteModel
 from recipes.models import Ingredient as IngredientModel
-from recipes.models import IngredientRecipe as IngredientRecipeModel
 from recipes.models import Recipe as RecipeModel
+from recipes.models import ShoppingListItem as ShoppingListItemModel
 from recipes.models import ShoppingСart as ShoppingСartModel
 from recipes.models import Tag as TagModel
 from rest_framework import status
 from rest_framework.decorators import action
-from rest_framework.permissions import (IsAuthenticated,
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import (IsAdminUser, IsAuthenticated,
                                         IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
+from users.models import Follow as FollowModel
 
 UserModel = get_user_model()
 
 
-class UserViewSet(BaseUserViewSet):
+class UserViewSet(OptionalCursorPaginationMixin, BaseUserViewSet):
     '''ViewSet for Users'''
     queryset = UserModel.objects.all()
     serializer_class = UserSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
+    replica_reads = True
     pagination_class = CustomPagination
+    cursor_pagination_classes = {
+        'subscriptions': SubscriptionCursorPagination,
+    }
 
-    def _get_subs_context(self):
-        context = self.get_serializer_context()
-        context['recipes_limit'] = self.request.query_params.get(
-            'recipes_limit', None
-        )
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action not in ('list', 'retrieve') or membership_cache.shared:
+            return queryset
+
+        if self.request.user.is_anonymous:
+            return queryset.annotate(is_subscribed=Value(False))
+
+        return queryset.annotate(is_subscribed=Exists(
+            FollowModel.objects.filter(
+                user=self.request.user, author=OuterRef('pk'),
+            )
+        ))
+
+    def _get_recipes_limit(self):
+        recipes_limit = self.request.query_params.get('recipes_limit')
+        if recipes_limit is None:
+            return None
+        try:
+            recipes_limit = int(recipes_limit)
+        except ValueError:
+            recipes_limit = -1
+        if recipes_limit < 0:
+            raise BadRequest('Invalid request. Must be a number.')
+        return recipes_limit
+
+    def _get_subscriptions_queryset(self):
+        return self.get_queryset().filter(
+            following__user=self.request.user
+        ).annotate(created=F('following__created'))
+
+    def _add_latest_recipes(self, authors, recipes_limit):
+        '''Fetch the latest recipes of all the authors in one query.'''
+        authors = list(authors)
+        prefetch_related_objects(authors, Prefetch(
+            'recipes',
+            queryset=RecipeModel.objects.latest_per_author(
+                [author.pk for author in authors], recipes_limit
+            ),
+            to_attr='latest_recipes',
+        ))
+        return authors
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['memberships'] = membership_cache.for_user(self.request.user)
         return context
 
     def get_serializer_class(self):
@@ -77,6 +143,7 @@ class UserViewSet(BaseUserViewSet):
             return Response(status=status.HTTP_204_NO_CONTENT)
 
         if request.method == 'POST':
+            recipes_limit = self._get_recipes_limit()
             if request.user.pk == author.pk:
                 return Response(status=status.HTTP_400_BAD_REQUEST, data={
                     'errors': 'You cannot subscribe to yourself',
@@ -89,21 +156,12 @@ class UserViewSet(BaseUserViewSet):
 
             author.following.create(user=request.user)
 
-            subs_context = self._get_subs_context()
-            queryset = self.get_queryset()
-            queryset = queryset.filter(following__user=self.request.user)
-            queryset = self.filter_queryset(queryset)
-            page = self.paginate_queryset(queryset)
-            if page is not None:
-                serializer = UserWithRecipesSerializer(
-                    page, many=True, context=subs_context
-                )
-                response = self.get_paginated_response(serializer.data)
-                response.status = status.HTTP_201_CREATED
-                return response
-
+            author = self._add_latest_recipes(
+                self._get_subscriptions_queryset().filter(pk=author.pk),
+                recipes_limit,
+            )[0]
             serializer = UserWithRecipesSerializer(
-                queryset, many=True, context=subs_context
+                author, context=self.get_serializer_context()
             )
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -114,49 +172,87 @@ class UserViewSet(BaseUserViewSet):
     )
     def subscriptions(self, request, *args, **kwargs):
         '''Getting a list of subscriptions.'''
-        context = self._get_subs_context()
-        queryset = self.get_queryset()
-        queryset = queryset.filter(following__user=request.user)
+        recipes_limit = self._get_recipes_limit()
+        context = self.get_serializer_context()
+        queryset = self._get_subscriptions_queryset()
         page = self.paginate_queryset(queryset)
         if page is not None:
             serializer = UserWithRecipesSerializer(
-                page, many=True, context=context
+                self._add_latest_recipes(page, recipes_limit),
+                many=True, context=context,
             )
             return self.get_paginated_response(serializer.data)
 
-        queryset = queryset.all()
         serializer = UserWithRecipesSerializer(
-            instance=queryset, many=True, context=context
+            instance=self._add_latest_recipes(queryset, recipes_limit),
+            many=True, context=context,
         )
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class TagViewSet(ReadOnlyModelViewSet):
+class TagViewSet(CatalogCacheMixin, ReadOnlyModelViewSet):
     '''ViewSet for Tags.'''
     queryset = TagModel.objects.all()
     serializer_class = TagSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
+    replica_reads = True
     pagination_class = None
 
 
-class IngredientViewSet(ReadOnlyModelViewSet):
+class IngredientViewSet(CatalogCacheMixin, ReadOnlyModelViewSet):
     '''ViewSet for Ingredients.'''
     queryset = IngredientModel.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
-    filter_backends = (DjangoFilterBackend,)
-    filterset_class = IngredientFilter
+    replica_reads = True
+    filter_backends = ()
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if name is None:
+            return super().list(request, *args, **kwargs)
+
+        # Autocomplete is answered from the in-memory index, not the DB.
+        return self._catalog_response(
+            request, lambda: Response(ingredient_index.search(name))
+        )
 
-class RecipeViewSet(ModelViewSet):
+
+class RecipeViewSet(OptionalCursorPaginationMixin, ModelViewSet):
     '''ViewSet for Recipes. '''
     queryset = RecipeModel.objects.all()
     serializer_class = RecipeReadSerializer
     permission_classes = (IsAuthorOrAdminOrReadOnly,)
+    replica_reads = True
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
     pagination_class = CustomPagination
+    parser_classes = (BoundedJSONParser, BoundedMultiPartParser)
+    cursor_pagination_classes = {
+        'list': RecipeCursorPagination,
+        'feed': FeedCursorPagination,
+    }
+    # Ranked by relevance, ordered by popularity or oldest first.
+    cursor_conflicting_params = ('search', 'ordering')
+
+    def get_queryset(self):
+        return self._with_user_flags(self.queryset.with_related())
+
+    def _with_user_flags(self, queryset):
+        '''Annotate the flags, unless all workers share the membership cache.'''
+        if membership_cache.shared:
+            return queryset
+        return queryset.with_user_flags(self.request.user)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['memberships'] = membership_cache.for_user(self.request.user)
+        return context
+
+    def _get_read_instance(self, instance):
+        '''Re-read a written recipe with the relations used for reading.'''
+        return self.get_queryset().get(pk=instance.pk)
 
     def create(self, request, *args, **kwargs):
         write_serializer = RecipeWriteSerializer(
@@ -166,7 +262,7 @@ class RecipeViewSet(ModelViewSet):
         self.perform_create(write_serializer)
 
         read_serializer = self.get_serializer(
-            instance=write_serializer.instance
+            instance=self._get_read_instance(write_serializer.instance)
         )
         headers = self.get_success_headers(data=read_serializer.data)
         return Response(
@@ -186,11 +282,8 @@ class RecipeViewSet(ModelViewSet):
         write_serializer.is_valid(raise_exception=True)
         self.perform_update(write_serializer)
 
-        if getattr(instance, '_prefetched_objects_cache', None):
-            instance._prefetched_objects_cache = {}
-
         read_serializer = self.get_serializer(
-            instance=write_serializer.instance
+            instance=self._get_read_instance(write_serializer.instance)
         )
         headers = self.get_success_headers(data=read_serializer.data)
         return Response(
@@ -199,6 +292,24 @@ class RecipeViewSet(ModelViewSet):
             headers=headers
         )
 
+    @action(
+        detail=False,
+        methods=['GET'],
+        permission_classes=(IsAuthenticated,),
+    )
+    def feed(self, request):
+        '''Recipes of the followed authors, newest first.'''
+        queryset = self.filter_queryset(
+            self._with_user_flags(recipes_for(request.user).with_related())
+        )
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
     @action(
         detail=True,
         methods=['POST', 'DELETE'],
@@ -294,36 +405,85 @@ class RecipeViewSet(ModelViewSet):
     @action(
         detail=False,
         methods=['GET'],
-        permission_classes=(IsAuthenticated,)
+        permission_classes=(IsAuthenticated,),
+        renderer_classes=(
+            TxtExportRenderer, CsvExportRenderer, PdfExportRenderer,
+        ),
+        content_negotiation_class=ExportFormatNegotiation,
     )
     def download_shopping_cart(self, request, *args, **kwargs):
-        """ Получение корзины для покупок """
-        items = IngredientRecipeModel.objects.select_related(
-            'recipe', 'ingredient'
+        """ Получение корзины для покупок, ?format=txt|csv|pdf """
+        renderer = request.accepted_renderer
+        rows = ShoppingListItemModel.objects.filter(
+            user=request.user, amount__gt=0,
+        ).order_by('-amount').values_list(
+            'ingredient__name', 'ingredient__measurement_unit', 'amount',
+        ).iterator(chunk_size=2000)
+
+        response = StreamingHttpResponse(
+            renderer.stream(rows), content_type=renderer.media_type,
         )
-        if request.user.is_authenticated:
-            items = items.filter(
-                recipe__shopping_cart__user=request.user
-            )
-        else:
-            items = items.filter(
-                recipe_id__in=request.session['purchases']
+        filename = f'foodgram_shopping_cart.{renderer.format}'
+        response['Content-Disposition'] = f'attachment; filename={filename}'
+        return response
+
+
+class RecipeImportView(APIView):
+    '''Import of a small NDJSON file of recipes, in one transaction.
+
+    Files of more than MAX_UPLOAD_LINES lines would outlast the worker
+    timeout and are refused, they are imported with the importrecipes
+    command. Images are decoded in the worker, not in a process pool.
+    The view is routed without ATOMIC_REQUESTS, the importer has its own
+    transaction. Recipes without an author get the one named by the
+    author field or the admin making the request.
+    '''
+    max_lines = RECIPE_IMPORT['MAX_UPLOAD_LINES']
+    permission_classes = (IsAdminUser,)
+    parser_classes = (MultiPartParser,)
+
+    def post(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response(
+                {'file': ['An NDJSON file is required.']},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        items = items.values(
-            'ingredient__name', 'ingredient__measurement_unit'
-        ).annotate(
-            name=F('ingredient__name'),
-            units=F('ingredient__measurement_unit'),
-            total=Sum('amount'),
-        ).order_by('-total')
-
-        text = '\n'.join([
-            f"{item['name']} ({item['units']}) - {item['total']}"
-            for item in items
-        ])
-        filename = "foodgram_shopping_cart.txt"
-        response = HttpResponse(text, content_type='text/plain')
-        response['Content-Disposition'] = f'attachment; filename{filename}'
+        if sum(1 for _ in islice(upload, self.max_lines + 1)) > self.max_lines:
+            return Response(
+                {'file': [
+                    f'At most {self.max_lines} lines can be uploaded, '
+                    'import larger files with manage.py importrecipes.'
+                ]},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
+        upload.seek(0)
 
-        return response
+        author = request.user
+        if request.data.get('author'):
+            try:
+                author = UserModel.objects.get(
+                    username=request.data['author']
+                )
+            except UserModel.DoesNotExist:
+                return Response(
+                    {'author': ['Unknown author.']},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+        summary = RecipeImporter(
+            author=author, batch_size=self.max_lines, workers=0,
+        ).run(upload)
+        return Response(summary)
+
+
+class CacheStatsView(APIView):
+    '''Hit rates and sizes of the in-process caches of this worker.'''
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response({
+            'membership': membership_cache.stats(),
+            'tokens': token_cache.stats(),
+            'db_queries': query_counts(),
+        })
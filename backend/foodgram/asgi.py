@@ -1,7 +1,9 @@
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from foodgram.handlers import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+application = ASGIHandler()
@@ -0,0 +1,186 @@
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.backends.signals import connection_created
+from foodgram.settings import DB_CONNECTIONS, DB_REPLICAS, TRANSACTION_POLICY
+from rest_framework.permissions import SAFE_METHODS
+
+_read_replica = ContextVar('read_replica', default=False)
+
+STICKY_COOKIE = 'db_primary'
+
+_query_counts = Counter()
+_query_counts_lock = threading.Lock()
+
+
+def replica_aliases():
+    '''Aliases of the databases that mirror the primary.'''
+    return [
+        alias for alias, database in settings.DATABASES.items()
+        if database.get('TEST', {}).get('MIRROR') == DEFAULT_DB_ALIAS
+    ]
+
+
+class ReplicaRouter:
+    '''Reads from a random replica while ReplicaMiddleware allows it.'''
+
+    def __init__(self):
+        self.replicas = replica_aliases()
+
+    def db_for_read(self, model, **hints):
+        if self.replicas and _read_replica.get():
+            return random.choice(self.replicas)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db not in self.replicas
+
+
+@contextmanager
+def read_primary():
+    '''Read from the primary in the block, even in a replica view.'''
+    token = _read_replica.set(False)
+    try:
+        yield
+    finally:
+        _read_replica.reset(token)
+
+
+class ReplicaMiddleware:
+    '''Sends the reads of safe requests to the replicas.
+
+    Only views with replica_reads = True read from replicas. A client
+    that wrote gets a signed cookie and reads from the primary for
+    STICKY_SECONDS, on whichever worker its next requests land, so it
+    sees its own favorites, cart and subscriptions. Streamed bodies are
+    read from the primary. Must come before TransactionPolicyMiddleware.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = bool(replica_aliases())
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # Under ASGI the view may have run in a copy of this context, a
+        # reset token of process_view would not be valid here.
+        _read_replica.set(False)
+        if (
+            self.enabled and request.method not in SAFE_METHODS
+            and response.status_code < 400
+        ):
+            response.set_signed_cookie(
+                STICKY_COOKIE, '1', salt=STICKY_COOKIE,
+                max_age=DB_REPLICAS['STICKY_SECONDS'], httponly=True,
+                samesite='Lax',
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', None)
+        if (
+            self.enabled and request.method in SAFE_METHODS
+            and getattr(view_class, 'replica_reads', False)
+        ):
+            sticky = request.get_signed_cookie(
+                STICKY_COOKIE, default=None, salt=STICKY_COOKIE,
+                max_age=DB_REPLICAS['STICKY_SECONDS'],
+            )
+            if sticky is None:
+                _read_replica.set(True)
+
+
+class TransactionPolicyMiddleware:
+    '''Runs the views of unsafe requests in a transaction.
+
+    With TRANSACTION_POLICY 'writes', GET, HEAD and OPTIONS run in
+    autocommit and skip the BEGIN and COMMIT round trips. Views marked
+    with transaction.non_atomic_requests are left alone. Must be the
+    last view middleware: it calls the view itself. An error response
+    rolls the transaction back, DRF only marks the rollback of a handled
+    exception under ATOMIC_REQUESTS.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (
+            TRANSACTION_POLICY != 'writes'
+            or request.method in SAFE_METHODS
+            or DEFAULT_DB_ALIAS in getattr(
+                view_func, '_non_atomic_requests', ()
+            )
+        ):
+            return None
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            response = view_func(request, *view_args, **view_kwargs)
+            if response.status_code >= 400:
+                transaction.set_rollback(True, using=DEFAULT_DB_ALIAS)
+            return response
+
+
+def _check_connections(**kwargs):
+    '''Close persistent connections that were dropped while idle.
+
+    Django 3.2 only notices a dead connection when a query fails, a
+    connection idle for longer than HEALTH_CHECK_IDLE is pinged first.
+    '''
+    now = time.monotonic()
+    for connection in connections.all():
+        idle_since = getattr(connection, 'idle_since', None)
+        if (
+            connection.connection is not None and idle_since is not None
+            and now - idle_since > DB_CONNECTIONS['HEALTH_CHECK_IDLE']
+            and not connection.is_usable()
+        ):
+            connection.close()
+
+
+def _mark_idle(**kwargs):
+    now = time.monotonic()
+    for connection in connections.all():
+        connection.idle_since = now
+
+
+def _count_query(execute, sql, params, many, context):
+    with _query_counts_lock:
+        _query_counts[context['connection'].alias] += 1
+    return execute(sql, params, many, context)
+
+
+def _connection_created(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def query_counts():
+    '''Queries run on every database alias by this worker.'''
+    with _query_counts_lock:
+        return dict(_query_counts)
+
+
+def connect_signals():
+    connection_created.connect(
+        _connection_created, dispatch_uid='db_count_queries',
+    )
+    request_started.connect(
+        _check_connections, dispatch_uid='db_check_connections',
+    )
+    request_finished.connect(_mark_idle, dispatch_uid='db_mark_idle')
@@ -0,0 +1,59 @@
+from itertools import islice
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.core.handlers import asgi
+
+
+def _next_parts(iterator, count=8):
+    return list(islice(iterator, count))
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    '''The ASGI handler of Django 3.2 with the threading of Django 4.
+
+    Django 3.2 runs the sync middleware and views of every request in one
+    thread shared by the whole process, here each request gets a thread
+    of its own. Streamed responses are generated in that thread instead
+    of the event loop, where their database queries are not allowed, and
+    a slow client holds no thread while a part is sent.
+    '''
+
+    async def __call__(self, scope, receive, send):
+        async with ThreadSensitiveContext():
+            await super().__call__(scope, receive, send)
+
+    async def send_response(self, response, send):
+        if response.streaming:
+            await self._send_streaming(response, send)
+        else:
+            await super().send_response(response, send)
+
+    async def _send_streaming(self, response, send):
+        headers = [
+            (header.encode('ascii'), value.encode('latin1'))
+            for header, value in response.items()
+        ]
+        headers.extend(
+            (b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+            for cookie in response.cookies.values()
+        )
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': headers,
+        })
+        iterator = iter(response)
+        next_parts = sync_to_async(_next_parts, thread_sensitive=True)
+        while True:
+            parts = await next_parts(iterator)
+            if not parts:
+                break
+            for part in parts:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
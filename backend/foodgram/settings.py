@@ -50,6 +50,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'foodgram.db.ReplicaMiddleware',
+    'foodgram.db.TransactionPolicyMiddleware',
 ]
 
 ROOT_URLCONF = 'foodgram.urls'
@@ -71,13 +73,44 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'foodgram.wsgi.application'
+ASGI_APPLICATION = 'foodgram.asgi.application'
+
+# 'wsgi' for gunicorn sync workers, 'asgi' for uvicorn workers.
+SERVER_MODE = os.getenv('SERVER_MODE', 'wsgi')
+
+# 'writes': only requests with unsafe methods run in a transaction, reads
+# run in autocommit. 'all': every request does, as with ATOMIC_REQUESTS.
+TRANSACTION_POLICY = os.getenv('TRANSACTION_POLICY', 'writes')
+
+DB_CONNECTIONS = {
+    # Seconds a connection is reused for, 0 closes it after each request.
+    # Under ASGI every request has its own thread, connections cannot be
+    # reused, use PgBouncer instead.
+    'MAX_AGE': int(os.getenv(
+        'DB_CONN_MAX_AGE', 0 if SERVER_MODE == 'asgi' else 60
+    )),
+    # A connection idle for longer is pinged before a request uses it.
+    'HEALTH_CHECK_IDLE': int(os.getenv('DB_HEALTH_CHECK_IDLE', 30)),
+    # PgBouncer in transaction pooling mode drops server-side cursors
+    # between transactions.
+    'PGBOUNCER': os.getenv('DB_PGBOUNCER', '').lower() in ('1', 'true'),
+}
+
+DB_REPLICAS = {
+    # Comma separated hosts of read replicas of the PostgreSQL database.
+    'HOSTS': [
+        host for host in os.getenv('DB_REPLICA_HOSTS', '').split(',') if host
+    ],
+    # Seconds a client that wrote reads from the primary.
+    'STICKY_SECONDS': int(os.getenv('DB_REPLICA_STICKY_SECONDS', 10)),
+}
 
 if DEBUG:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-            'ATOMIC_REQUESTS': 'TRUE',
+            'ATOMIC_REQUESTS': TRANSACTION_POLICY == 'all',
         }
     }
 else:
@@ -89,9 +122,31 @@ else:
             'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
             'HOST': os.getenv('DB_HOST', ''),
             'PORT': os.getenv('DB_PORT', 5432),
-            'ATOMIC_REQUESTS': 'TRUE',
+            'ATOMIC_REQUESTS': TRANSACTION_POLICY == 'all',
+            'CONN_MAX_AGE': DB_CONNECTIONS['MAX_AGE'],
+            'DISABLE_SERVER_SIDE_CURSORS': DB_CONNECTIONS['PGBOUNCER'],
         }
     }
+    for number, host in enumerate(DB_REPLICAS['HOSTS']):
+        # The router reads from the aliases that mirror the primary.
+        DATABASES[f'replica_{number}'] = {
+            **DATABASES['default'],
+            'HOST': host,
+            'ATOMIC_REQUESTS': False,
+            'TEST': {'MIRROR': 'default'},
+        }
+
+DATABASE_ROUTERS = ['foodgram.db.ReplicaRouter']
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache',
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'foodgram'),
+    }
+}
 
 AUTH_USER_MODEL = 'users.User'
 AUTH_PASSWORD_VALIDATORS = [
@@ -136,7 +191,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
@@ -166,3 +221,57 @@ DJOSER = {
 MAX_EMAIL_LENGHT = 254
 MAX_LENGHT_1 = 150
 MAX_LENGHT_2 = 200
+PAGINATION_COUNT_CAP = 1000
+TOKEN_CACHE = {
+    # A cache shared by all workers (memcached), without one the cached
+    # users of the tokens expire after LOCAL_TTL.
+    'ALIAS': os.getenv('TOKEN_CACHE_ALIAS') or None,
+    'MAX_TOKENS': int(os.getenv('TOKEN_CACHE_MAX_TOKENS', 10000)),
+    'TTL': int(os.getenv('TOKEN_CACHE_TTL', 60)),
+    'LOCAL_TTL': float(os.getenv('TOKEN_CACHE_LOCAL_TTL', 1)),
+}
+MEMBERSHIP_CACHE = {
+    # A cache shared by all workers (memcached), without one the flags are
+    # Exists() annotations of the queries.
+    'ALIAS': os.getenv('MEMBERSHIP_CACHE_ALIAS') or None,
+    'MAX_USERS': int(os.getenv('MEMBERSHIP_CACHE_MAX_USERS', 10000)),
+    'TTL': int(os.getenv('MEMBERSHIP_CACHE_TTL', 60)),
+}
+CATALOG_CACHE = {
+    'MAX_AGE': int(os.getenv('CATALOG_CACHE_MAX_AGE', 300)),
+    # Seconds a process reuses the catalog version read from the database.
+    'VERSION_TTL': float(os.getenv('CATALOG_VERSION_TTL', 1)),
+    'TIMEOUT': int(os.getenv('CATALOG_CACHE_TIMEOUT', 24 * 60 * 60)),
+}
+INGREDIENT_INDEX = {
+    'PATH': os.getenv('INGREDIENT_INDEX_PATH') or None,
+}
+RECIPE_IMPORT = {
+    'BATCH_SIZE': int(os.getenv('RECIPE_IMPORT_BATCH_SIZE', 500)),
+    'WORKERS': int(os.getenv('RECIPE_IMPORT_WORKERS', 2)),
+    # Lines of an upload to POST /api/recipes/import/, imported in one
+    # transaction within the request; larger files go to importrecipes.
+    'MAX_UPLOAD_LINES': int(os.getenv('RECIPE_IMPORT_MAX_UPLOAD_LINES', 1000)),
+}
+IMAGE_DERIVATIVES = {
+    'WORKERS': int(os.getenv('IMAGE_DERIVATIVES_WORKERS', 2)),
+    'QUALITY': int(os.getenv('IMAGE_DERIVATIVES_QUALITY', 80)),
+    # Twice the size the frontend displays them at, cropped to fit.
+    'SIZES': {
+        'card': (720, 480),
+        'detail': (960, 960),
+        'small': (144, 144),
+    },
+}
+IMAGE_UPLOAD = {
+    'MAX_BYTES': int(os.getenv('IMAGE_UPLOAD_MAX_BYTES', 10 * 1024 * 1024)),
+    'MAX_PIXELS': int(os.getenv('IMAGE_UPLOAD_MAX_PIXELS', 40 * 10 ** 6)),
+    # Room for the rest of a recipe next to a base64 encoded image.
+    'MAX_BODY_OVERHEAD': 1024 * 1024,
+}
+FEED = {
+    # Recipes of authors with more followers are read at request time
+    # instead of being copied into every follower's feed.
+    'FANOUT_LIMIT': int(os.getenv('FEED_FANOUT_LIMIT', 10000)),
+    'BATCH_SIZE': int(os.getenv('FEED_BATCH_SIZE', 1000)),
+}
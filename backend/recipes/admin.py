@@ -1,23 +1,97 @@
 from django.contrib import admin
 from django.contrib.admin import TabularInline
+from django.contrib.auth import get_user_model
 from django.utils.safestring import mark_safe
+from recipes import counters, tag_bits
 from recipes.models import (Favorite, Ingredient, IngredientRecipe, Recipe,
-                            ShoppingСart, Tag)
+                            ShoppingСart, Tag, TagRecipe)
+
+User = get_user_model()
+
+
+class AuthorListFilter(admin.SimpleListFilter):
+    '''Authors with the most recipes, a page of them at a time.'''
+    title = 'author'
+    parameter_name = 'author'
+    page_parameter = 'author_page'
+    page_size = 20
+
+    def __init__(self, request, params, model, model_admin):
+        try:
+            self.page = max(1, int(params.pop(self.page_parameter, 1)))
+        except ValueError:
+            self.page = 1
+        super().__init__(request, params, model, model_admin)
+
+    def expected_parameters(self):
+        return [self.parameter_name, self.page_parameter]
+
+    def lookups(self, request, model_admin):
+        offset = (self.page - 1) * self.page_size
+        authors = list(
+            User.objects.filter(recipes_count__gt=0).order_by(
+                '-recipes_count', 'pk'
+            ).values_list('pk', 'username')[offset:offset + self.page_size + 1]
+        )
+        self.has_next = len(authors) > self.page_size
+        authors = authors[:self.page_size]
+        if self.value() and self.value() not in {
+            str(pk) for pk, _ in authors
+        }:
+            authors[:0] = User.objects.filter(
+                pk=self.value()
+            ).values_list('pk', 'username')
+        return authors
+
+    def choices(self, changelist):
+        yield from super().choices(changelist)
+        for page, display, shown in (
+            (self.page - 1, '← previous authors', self.page > 1),
+            (self.page + 1, 'more authors →', self.has_next),
+        ):
+            if shown:
+                yield {
+                    'selected': False,
+                    'query_string': changelist.get_query_string(
+                        {self.page_parameter: page}
+                    ),
+                    'display': display,
+                }
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(author_id=self.value())
+        return queryset
 
 
 @admin.register(Ingredient)
 class IngredientAdmin(admin.ModelAdmin):
     list_display = ('name', 'measurement_unit',)
     search_fields = ('name', 'measurement_unit',)
-    list_filter = ('name',)
+    list_filter = ('measurement_unit',)
     empty_value_display = '- empty -'
 
 
 class IngredientRecipeInline(TabularInline):
     model = IngredientRecipe
+    autocomplete_fields = ('ingredient',)
     min_num = 1
     extra = 1
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(
+            'recipe', 'ingredient'
+        )
+
+
+class TagRecipeInline(TabularInline):
+    model = TagRecipe
+    autocomplete_fields = ('tag',)
+    extra = 1
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('recipe', 'tag')
+
 
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
@@ -31,26 +105,46 @@ class TagAdmin(admin.ModelAdmin):
 class RecipeAdmin(admin.ModelAdmin):
     list_display = ('id', 'author', 'name', 'get_ingredients',
                     'get_tags', 'favorite')
-    fields = ('name', 'author', 'text', 'image',)
-    search_fields = ('name', 'author', 'tags')
-    list_filter = ('name', 'author', 'tags')
-    inlines = (IngredientRecipeInline,)
+    fields = ('name', 'author', 'text', 'image', 'cooking_time',)
+    search_fields = ('name', 'author__username')
+    list_filter = ('tags', AuthorListFilter)
+    autocomplete_fields = ('author',)
+    inlines = (IngredientRecipeInline, TagRecipeInline)
     empty_value_display = '- empty -'
+    # The exact total of a search would be a second COUNT over the table.
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(
+            'author'
+        ).prefetch_related('ingredients', 'tags')
 
     @admin.display(description='Image')
     def get_image(self, obj):
         return mark_safe(f'<img src={obj.image.url} width="80" hieght="30"')
 
-    @admin.display(description='Favorite')
+    @admin.display(description='Favorite', ordering='favorites_count')
     def favorite(self, obj):
-        return obj.favorite.count()
+        return obj.favorites_count
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'author' in form.changed_data:
+            # The counter signals only see recipes created and deleted.
+            counters.add({'recipes_count': {
+                form.initial.get('author'): -1, obj.author_id: 1,
+            }})
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # The tags are saved by the inline, after the recipe.
+        tag_bits.update_masks([form.instance.pk])
 
     @admin.display(description='Ingredients')
     def get_ingredients(self, obj):
-        ingredients_list = []
-        for ingredient in obj.ingredients.all():
-            ingredients_list.append(ingredient.name.lower())
-        return ', '.join(ingredients_list)
+        return ', '.join(
+            ingredient.name.lower() for ingredient in obj.ingredients.all()
+        )
 
     @admin.display(description='Tags')
     def get_tags(self, obj):
@@ -61,12 +155,16 @@ class RecipeAdmin(admin.ModelAdmin):
 @admin.register(ShoppingСart)
 class ShoppingAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'recipe',)
-    search_fields = ('user', 'recipe', )
+    list_select_related = ('user', 'recipe')
+    search_fields = ('user__username', 'recipe__name', )
+    autocomplete_fields = ('user', 'recipe')
     empty_value_display = '- empty -'
 
 
 @admin.register(Favorite)
 class FavoriteAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'recipe',)
-    search_fields = ('user', 'recipe', )
+    list_select_related = ('user', 'recipe')
+    search_fields = ('user__username', 'recipe__name', )
+    autocomplete_fields = ('user', 'recipe')
     empty_value_display = '- empty -'
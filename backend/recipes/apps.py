@@ -6,3 +6,25 @@ class RecipesConfig(AppConfig):
     name = 'recipes'
     verbose_name = 'recipe'
     verbose_name_plural = 'recipes'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+        from recipes import (autocomplete, catalog, counters, feed, images,
+                             indexes, search, shopping_list, tag_bits)
+
+        # The catalog version has to be bumped before the index reads it.
+        catalog.connect_signals()
+        autocomplete.connect_signals()
+        shopping_list.connect_signals()
+        images.connect_signals()
+        feed.connect_signals()
+        counters.connect_signals()
+        tag_bits.connect_signals()
+        post_migrate.connect(search.install_search_indexes, sender=self)
+        post_migrate.connect(indexes.install_indexes, sender=self)
+        post_migrate.connect(tag_bits.install_tag_bits, sender=self)
+        post_migrate.connect(
+            shopping_list.install_shopping_lists, sender=self,
+        )
+        post_migrate.connect(counters.install_counters, sender=self)
+        post_migrate.connect(feed.install_feeds, sender=self)
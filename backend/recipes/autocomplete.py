@@ -0,0 +1,339 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_right
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from foodgram.settings import INGREDIENT_INDEX
+from recipes.catalog import get_catalog_version, last_bump
+from recipes.models import Ingredient
+
+MAGIC = b'FGII1\n'
+HEADER = struct.Struct('<6sqIII')
+
+# Tabs separate the fields of a row and newlines the keys and rows, names
+# may contain both.
+_SEPARATORS = str.maketrans('\t\n', '  ')
+
+
+def flat(text):
+    '''Text with its tabs and newlines replaced by spaces.'''
+    return text.translate(_SEPARATORS)
+
+
+def fold(text):
+    '''Case-fold a name for matching, treating ё as е.'''
+    return text.casefold().replace('ё', 'е')
+
+
+def _splice(offsets, number, count, size):
+    '''Offsets with count entries at number replaced by one of size bytes.
+
+    A size of 0 replaces them with nothing.
+    '''
+    start, end = offsets[number], offsets[number + count]
+    delta = size - (end - start)
+    result = offsets[:number + 1]
+    if size:
+        result.append(start + size)
+    result.extend(offset + delta for offset in offsets[number + count + 1:])
+    return result
+
+
+class _Snapshot:
+    '''Keys and rows of one catalog version, never changed once made.
+
+    Both live in one bytes object or one mmap. A search reads the current
+    snapshot once, a rebuild or an update swaps in a new one.
+    '''
+
+    __slots__ = (
+        'version', 'buffer', 'keys_start', 'rows_start', 'key_offsets',
+        'row_offsets',
+    )
+
+    def __init__(self, version, buffer, keys_start, rows_start, key_offsets,
+                 row_offsets):
+        self.version = version
+        self.buffer = buffer
+        self.keys_start = keys_start
+        self.rows_start = rows_start
+        self.key_offsets = key_offsets
+        self.row_offsets = row_offsets
+
+    @classmethod
+    def of(cls, version, keys, key_offsets, rows, row_offsets):
+        return cls(
+            version, bytes(keys) + bytes(rows), 0, len(keys), key_offsets,
+            row_offsets,
+        )
+
+    def __len__(self):
+        return len(self.key_offsets) - 1
+
+    def keys(self):
+        return self.buffer[
+            self.keys_start:self.keys_start + self.key_offsets[-1]
+        ]
+
+    def rows(self):
+        return self.buffer[
+            self.rows_start:self.rows_start + self.row_offsets[-1]
+        ]
+
+    def key(self, number):
+        start = self.keys_start
+        offsets = self.key_offsets
+        return self.buffer[
+            start + offsets[number]:start + offsets[number + 1] - 1
+        ]
+
+    def row(self, number):
+        start = self.rows_start
+        offsets = self.row_offsets
+        pk, name, unit = self.buffer[
+            start + offsets[number]:start + offsets[number + 1] - 1
+        ].decode().split('\t')
+        return {'id': int(pk), 'name': name, 'measurement_unit': unit}
+
+    def first_not_less(self, key):
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def number_of(self, pk):
+        '''Number of the row of the ingredient, None if it is not here.'''
+        needle = f'{pk}\t'.encode()
+        rows = self.rows()
+        if rows.startswith(needle):
+            return 0
+        position = rows.find(b'\n' + needle)
+        if position < 0:
+            return None
+        return bisect_right(self.row_offsets, position + 1) - 1
+
+    def replaced(self, number, count, version, pk=None, name=None,
+                 unit=None):
+        '''A copy with count entries at number replaced by one or none.'''
+        keys, rows = self.keys(), self.rows()
+        key = row = b''
+        if pk is not None:
+            name, unit = flat(name), flat(unit)
+            key = fold(name).encode() + b'\n'
+            row = f'{pk}\t{name}\t{unit}\n'.encode()
+        key_offsets, row_offsets = self.key_offsets, self.row_offsets
+        return _Snapshot.of(
+            version,
+            keys[:key_offsets[number]] + key
+            + keys[key_offsets[number + count]:],
+            _splice(key_offsets, number, count, len(key)),
+            rows[:row_offsets[number]] + row
+            + rows[row_offsets[number + count]:],
+            _splice(row_offsets, number, count, len(row)),
+        )
+
+
+EMPTY = _Snapshot(None, b'', 0, 0, array('I', [0]), array('I', [0]))
+
+
+class IngredientIndex:
+    '''Sorted in-process index over ingredient names for autocomplete.
+
+    Folded names are stored as one newline separated UTF-8 blob in sorted
+    order with an offsets array: prefix matches are a binary search and
+    substring matches a bytes.find() scan over the blob. The same layout
+    can be written to INGREDIENT_INDEX['PATH'] and memory-mapped, so that
+    gunicorn workers share one copy of the index through the page cache.
+
+    The index follows the catalog version: a single ingredient change is
+    spliced into a copy of the blobs, any other version change reloads
+    the shared file or rebuilds the index from the database. Writers hold
+    the lock, searches only read the current snapshot.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._snapshot = EMPTY
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def _build(self, entries, version):
+        entries = sorted(
+            (fold(name), pk, name, unit)
+            for pk, name, unit in (
+                (pk, flat(name), flat(unit)) for pk, name, unit in entries
+            )
+        )
+        keys, key_offsets = bytearray(), array('I', [0])
+        rows, row_offsets = bytearray(), array('I', [0])
+        for folded, pk, name, unit in entries:
+            keys += folded.encode() + b'\n'
+            key_offsets.append(len(keys))
+            rows += f'{pk}\t{name}\t{unit}\n'.encode()
+            row_offsets.append(len(rows))
+        return _Snapshot.of(version, keys, key_offsets, rows, row_offsets)
+
+    def rebuild(self):
+        version = get_catalog_version()
+        self._snapshot = self._build(
+            Ingredient.objects.values_list('id', 'name', 'measurement_unit'),
+            version,
+        )
+        if self.path:
+            self.save(self.path)
+
+    def save(self, path):
+        '''Atomically write the index in its memory-mappable layout.'''
+        snapshot = self._snapshot
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            f.write(HEADER.pack(
+                MAGIC, snapshot.version, len(snapshot),
+                snapshot.key_offsets[-1], snapshot.row_offsets[-1],
+            ))
+            f.write(snapshot.key_offsets.tobytes())
+            f.write(snapshot.row_offsets.tobytes())
+            f.write(snapshot.keys())
+            f.write(snapshot.rows())
+        os.replace(f.name, path)
+
+    def load(self, path):
+        '''Map a saved index, return False if the file is missing.'''
+        try:
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        magic, version, count, keys_size, _ = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            return False
+
+        position = HEADER.size
+        key_offsets = array('I')
+        key_offsets.frombytes(
+            buffer[position:position + 4 * (count + 1)]
+        )
+        position += 4 * (count + 1)
+        row_offsets = array('I')
+        row_offsets.frombytes(
+            buffer[position:position + 4 * (count + 1)]
+        )
+        position += 4 * (count + 1)
+        self._snapshot = _Snapshot(
+            version, buffer, position, position + keys_size, key_offsets,
+            row_offsets,
+        )
+        return True
+
+    def ensure_current(self):
+        version = get_catalog_version()
+        if version == self.version:
+            return
+        with self._lock:
+            if version == self.version:
+                return
+            if self.path and self.load(self.path) and (
+                self.version == version
+            ):
+                return
+            self.rebuild()
+
+    def apply(self, pk, name=None, unit=None):
+        '''Insert, replace or (with name=None) remove one ingredient.
+
+        Applied only to the snapshot of the version the change replaced,
+        any other one is reloaded by the next search.
+        '''
+        old_version, new_version = last_bump()
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot.version is None or snapshot.version != old_version:
+                return
+            number = snapshot.number_of(pk)
+            if number is not None:
+                snapshot = snapshot.replaced(number, 1, new_version)
+            if name is not None:
+                snapshot = snapshot.replaced(
+                    snapshot.first_not_less(fold(flat(name)).encode()), 0,
+                    new_version, pk, name, unit,
+                )
+            self._snapshot = snapshot
+            if self.path:
+                self.save(self.path)
+
+    def clear(self):
+        '''Forget the index, the next search loads or rebuilds it.'''
+        with self._lock:
+            self._snapshot = EMPTY
+
+    def search(self, query, limit=None):
+        '''Rows whose name starts with query, then rows that contain it.'''
+        self.ensure_current()
+        snapshot = self._snapshot
+        needle = fold(query.strip()).encode()
+        if not needle:
+            return [
+                snapshot.row(number) for number in range(len(snapshot))
+            ][:limit]
+
+        numbers = []
+        start = snapshot.first_not_less(needle)
+        end = start
+        while end < len(snapshot) and snapshot.key(end).startswith(needle):
+            numbers.append(end)
+            end += 1
+
+        offsets = snapshot.key_offsets
+        keys_start = snapshot.keys_start
+        keys_end = keys_start + offsets[-1]
+        position = keys_start
+        while limit is None or len(numbers) < limit:
+            position = snapshot.buffer.find(needle, position, keys_end)
+            if position < 0:
+                break
+            number = bisect_right(offsets, position - keys_start) - 1
+            if not start <= number < end:
+                numbers.append(number)
+            position = keys_start + offsets[number + 1]
+
+        return [snapshot.row(number) for number in numbers[:limit]]
+
+
+ingredient_index = IngredientIndex(path=INGREDIENT_INDEX['PATH'])
+
+
+def _ingredient_saved(sender, instance, **kwargs):
+    pk, name, unit = instance.pk, instance.name, instance.measurement_unit
+    transaction.on_commit(lambda: ingredient_index.apply(pk, name, unit))
+
+
+def _ingredient_deleted(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: ingredient_index.apply(pk))
+
+
+def connect_signals():
+    post_save.connect(
+        _ingredient_saved, sender=Ingredient,
+        dispatch_uid='ingredient_index_saved',
+    )
+    post_delete.connect(
+        _ingredient_deleted, sender=Ingredient,
+        dispatch_uid='ingredient_index_deleted',
+    )
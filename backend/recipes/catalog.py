@@ -0,0 +1,81 @@
+import threading
+import time
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from foodgram.settings import CATALOG_CACHE
+from recipes.models import CatalogVersion, Ingredient, Tag
+
+VERSION_PK = 1
+
+# (version, monotonic expiry) of the last read, replaced as a whole.
+_last_read = (None, 0)
+_bumps = threading.local()
+
+
+def get_catalog_version():
+    '''Version of the tag and ingredient catalogs, a nanosecond timestamp.
+
+    The version is a database row, so loadmodels and every worker see the
+    same one; a process reads it at most every VERSION_TTL seconds.
+    '''
+    global _last_read
+    version, expires = _last_read
+    if version is not None and expires > time.monotonic():
+        return version
+
+    version = CatalogVersion.objects.filter(pk=VERSION_PK).values_list(
+        'version', flat=True
+    ).first()
+    if version is None:
+        version = CatalogVersion.objects.get_or_create(
+            pk=VERSION_PK, defaults={'version': time.time_ns()},
+        )[0].version
+    _last_read = (version, time.monotonic() + CATALOG_CACHE['VERSION_TTL'])
+    return version
+
+
+def bump_catalog_version():
+    '''Replace the version, remember the old and new one for this thread.'''
+    global _last_read
+    version = time.time_ns()
+    with transaction.atomic():
+        old_version = CatalogVersion.objects.select_for_update().filter(
+            pk=VERSION_PK
+        ).values_list('version', flat=True).first()
+        if old_version is None:
+            CatalogVersion.objects.get_or_create(
+                pk=VERSION_PK, defaults={'version': version},
+            )
+        else:
+            CatalogVersion.objects.filter(pk=VERSION_PK).update(
+                version=version
+            )
+    _bumps.last = (old_version, version)
+    _last_read = (version, time.monotonic() + CATALOG_CACHE['VERSION_TTL'])
+
+
+def last_bump():
+    '''(old, new) versions of the last bump made by this thread.'''
+    return getattr(_bumps, 'last', (None, None))
+
+
+def clear():
+    global _last_read
+    _last_read = (None, 0)
+
+
+def _catalog_changed(sender, **kwargs):
+    transaction.on_commit(bump_catalog_version)
+
+
+def connect_signals():
+    for model in (Tag, Ingredient):
+        post_save.connect(
+            _catalog_changed, sender=model,
+            dispatch_uid=f'catalog_{model.__name__}_saved',
+        )
+        post_delete.connect(
+            _catalog_changed, sender=model,
+            dispatch_uid=f'catalog_{model.__name__}_deleted',
+        )
@@ -0,0 +1,124 @@
+from collections import Counter, defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, When
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, post_save
+from recipes.models import Favorite, Recipe, ShoppingСart
+from users.models import Follow
+
+User = get_user_model()
+
+# Counter field: (model holding it, counted model, its foreign key).
+COUNTERS = {
+    'favorites_count': (Recipe, Favorite, 'recipe'),
+    'carts_count': (Recipe, ShoppingСart, 'recipe'),
+    'recipes_count': (User, Recipe, 'author'),
+    'followers_count': (User, Follow, 'author'),
+    'following_count': (User, Follow, 'user'),
+}
+
+
+def add(changes):
+    '''Apply {counter field: {pk: delta}} with one UPDATE per model.'''
+    by_model = defaultdict(dict)
+    for field, deltas in changes.items():
+        deltas = {
+            pk: delta for pk, delta in deltas.items()
+            if pk is not None and delta
+        }
+        if deltas:
+            by_model[COUNTERS[field][0]][field] = deltas
+
+    for model, fields in by_model.items():
+        pks = set().union(*fields.values())
+        # Drift must not make a decrement fail on the CHECK >= 0.
+        model.objects.filter(pk__in=pks).update(**{
+            field: Greatest(F(field) + Case(
+                *(When(pk=pk, then=delta) for pk, delta in deltas.items()),
+                default=0,
+            ), 0)
+            for field, deltas in fields.items()
+        })
+
+
+def add_recipes(author_ids):
+    '''Count new recipes written without signals, e.g. by the importer.'''
+    add({'recipes_count': Counter(author_ids)})
+
+
+def _actual(field):
+    model, counted, foreign_key = COUNTERS[field]
+    return Coalesce(Subquery(
+        counted.objects.filter(**{foreign_key: OuterRef('pk')}).order_by()
+        .values(foreign_key).annotate(count=Count('pk')).values('count')
+    ), 0)
+
+
+def recompute(fields=None):
+    '''Repair the counters that differ from a fresh COUNT.
+
+    Returns {field: number of repaired rows}.
+    '''
+    repaired = {}
+    for field in fields or COUNTERS:
+        model = COUNTERS[field][0]
+        drifted = list(
+            model.objects.annotate(actual=_actual(field)).exclude(
+                **{field: F('actual')}
+            ).values_list('pk', flat=True)
+        )
+        if drifted:
+            model.objects.filter(pk__in=drifted).update(
+                **{field: _actual(field)}
+            )
+        repaired[field] = len(drifted)
+    return repaired
+
+
+@transaction.atomic
+def install_counters(**kwargs):
+    '''Count the rows that existed before the counter columns.
+
+    Run after migrate, the new columns start at 0. Only counters that
+    differ are written, so later runs are cheap.
+    '''
+    recompute()
+
+
+def _make_receivers(updates):
+    '''Signal receivers applying [(counter field, foreign key)] by +-1.'''
+
+    def saved(sender, instance, created, raw, **kwargs):
+        if created and not raw:
+            add({
+                field: {getattr(instance, foreign_key): 1}
+                for field, foreign_key in updates
+            })
+
+    def deleted(sender, instance, **kwargs):
+        add({
+            field: {getattr(instance, foreign_key): -1}
+            for field, foreign_key in updates
+        })
+
+    return saved, deleted
+
+
+def connect_signals():
+    sources = defaultdict(list)
+    for field, (_, counted, foreign_key) in COUNTERS.items():
+        sources[counted].append((field, f'{foreign_key}_id'))
+
+    for counted, updates in sources.items():
+        saved, deleted = _make_receivers(updates)
+        name = counted._meta.model_name
+        post_save.connect(
+            saved, sender=counted, weak=False,
+            dispatch_uid=f'counters_{name}_saved',
+        )
+        post_delete.connect(
+            deleted, sender=counted, weak=False,
+            dispatch_uid=f'counters_{name}_deleted',
+        )
@@ -0,0 +1,163 @@
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q, Subquery
+from django.db.models.signals import post_delete, post_save
+from foodgram.settings import FEED
+from recipes.models import FeedEntry, Recipe
+from users.models import Follow, User
+
+
+def is_pulled(author_id):
+    return User.objects.filter(
+        pk=author_id, followers_count__gt=FEED['FANOUT_LIMIT']
+    ).exists()
+
+
+def pulled_authors(user_id):
+    '''Authors followed by the user whose recipes are not copied.'''
+    return Follow.objects.filter(
+        user_id=user_id, author__followers_count__gt=FEED['FANOUT_LIMIT']
+    ).values_list('author_id', flat=True)
+
+
+def _insert(entries):
+    FeedEntry.objects.bulk_create(
+        entries, batch_size=FEED['BATCH_SIZE'], ignore_conflicts=True
+    )
+
+
+def fan_out(recipes):
+    '''Copy [(recipe_id, author_id, pub_date)] into the followers' feeds.
+
+    Authors with more than FANOUT_LIMIT followers are skipped, their
+    recipes are read when a follower opens the feed.
+    '''
+    by_author = {}
+    for recipe_id, author_id, pub_date in recipes:
+        if author_id is not None:
+            by_author.setdefault(author_id, []).append((recipe_id, pub_date))
+
+    limit = FEED['FANOUT_LIMIT']
+    for author_id, recipes in by_author.items():
+        follower_ids = list(Follow.objects.filter(
+            author_id=author_id
+        ).values_list('user_id', flat=True)[:limit + 1])
+        if len(follower_ids) > limit:
+            continue
+        _insert(
+            FeedEntry(user_id=user_id, recipe_id=recipe_id, pub_date=pub_date)
+            for user_id in follower_ids
+            for recipe_id, pub_date in recipes
+        )
+
+
+def backfill(user_id, author_id):
+    '''Copy the recipes of a newly followed author into the user's feed.'''
+    if is_pulled(author_id):
+        return
+    _insert(
+        FeedEntry(user_id=user_id, recipe_id=recipe_id, pub_date=pub_date)
+        for recipe_id, pub_date in Recipe.objects.filter(
+            author_id=author_id
+        ).values_list('pk', 'pub_date').iterator()
+    )
+
+
+def prune(user_id, author_id):
+    FeedEntry.objects.filter(
+        user_id=user_id, recipe__author_id=author_id
+    ).delete()
+
+
+def recipes_for(user):
+    '''Recipes of the feed of the user, newest first by feed_date.
+
+    Without pulled authors the recipes are read in the order of the feed
+    index, (user, -pub_date, recipe), and a page stops after its rows.
+    '''
+    pulled = list(pulled_authors(user.pk))
+    if pulled:
+        recipes = Recipe.objects.filter(
+            Q(pk__in=FeedEntry.objects.filter(user=user).values('recipe'))
+            | Q(author_id__in=pulled)
+        ).annotate(feed_date=F('pub_date'), feed_recipe=F('pk'))
+    else:
+        recipes = Recipe.objects.filter(feed_entries__user=user).annotate(
+            feed_date=F('feed_entries__pub_date'),
+            feed_recipe=F('feed_entries__recipe'),
+        )
+    return recipes.order_by('-feed_date', 'feed_recipe')
+
+
+def rebuild(user_ids=None):
+    '''Recreate the feeds of the users from their subscriptions.
+
+    Needed after FANOUT_LIMIT changes or an author crosses it.
+    '''
+    entries = FeedEntry.objects.all()
+    follows = Follow.objects.filter(
+        author__followers_count__lte=FEED['FANOUT_LIMIT'],
+        author__recipes__isnull=False,
+    )
+    if user_ids is not None:
+        entries = entries.filter(user_id__in=user_ids)
+        follows = follows.filter(user_id__in=user_ids)
+    entries.delete()
+    _insert(
+        FeedEntry(user_id=user_id, recipe_id=recipe_id, pub_date=pub_date)
+        for user_id, recipe_id, pub_date in follows.values_list(
+            'user_id', 'author__recipes', 'author__recipes__pub_date'
+        ).iterator()
+    )
+
+
+@transaction.atomic
+def install_feeds(**kwargs):
+    '''Fill the feeds the signals did not, run after migrate.
+
+    Entries made before FeedEntry.pub_date get the date of their recipe,
+    subscriptions made before the feeds existed get their recipes. Needs
+    the followers counts, so it runs after install_counters.
+    '''
+    FeedEntry.objects.filter(pub_date__isnull=True).update(
+        pub_date=Subquery(
+            Recipe.objects.filter(pk=OuterRef('recipe')).values('pub_date')
+        )
+    )
+    follows = Follow.objects.filter(
+        author__followers_count__lte=FEED['FANOUT_LIMIT'],
+        author__recipes__isnull=False,
+    ).exclude(Exists(FeedEntry.objects.filter(
+        user=OuterRef('user'), recipe__author=OuterRef('author'),
+    )))
+    _insert(
+        FeedEntry(user_id=user_id, recipe_id=recipe_id, pub_date=pub_date)
+        for user_id, recipe_id, pub_date in follows.values_list(
+            'user_id', 'author__recipes', 'author__recipes__pub_date'
+        ).iterator()
+    )
+
+
+def _recipe_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        fan_out([(instance.pk, instance.author_id, instance.pub_date)])
+
+
+def _follow_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        backfill(instance.user_id, instance.author_id)
+
+
+def _follow_deleted(sender, instance, **kwargs):
+    prune(instance.user_id, instance.author_id)
+
+
+def connect_signals():
+    post_save.connect(
+        _recipe_saved, sender=Recipe, dispatch_uid='feed_recipe_saved',
+    )
+    post_save.connect(
+        _follow_saved, sender=Follow, dispatch_uid='feed_follow_saved',
+    )
+    post_delete.connect(
+        _follow_deleted, sender=Follow, dispatch_uid='feed_follow_deleted',
+    )
@@ -0,0 +1,179 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from foodgram.settings import IMAGE_DERIVATIVES
+from PIL import Image, ImageOps
+from recipes.models import Recipe
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY = 'recipes/image/derivatives/'
+# Extension and Pillow format, the first one is the preferred format.
+FORMATS = (('webp', 'WEBP'), ('jpeg', 'JPEG'))
+
+_executor = None
+_pending = set()
+_lock = threading.Lock()
+
+
+def _fit_size(image, size):
+    '''The requested size, shrunk to the aspect ratio if it is too big.'''
+    scale = min(1, image.width / size[0], image.height / size[1])
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def _flatten(image):
+    '''JPEG has no alpha channel, put transparent images on white.'''
+    if image.mode == 'RGB':
+        return image
+    background = Image.new('RGB', image.size, 'white')
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def render_derivatives(file):
+    '''Encode every configured size in every format.
+
+    Returns {size name: {extension: bytes}}.
+    '''
+    with Image.open(file) as original:
+        original = ImageOps.exif_transpose(original)
+        original = original.convert(
+            'RGBA' if original.mode in ('RGBA', 'LA', 'P') else 'RGB'
+        )
+        rendered = {}
+        for name, size in IMAGE_DERIVATIVES['SIZES'].items():
+            resized = ImageOps.fit(
+                original, _fit_size(original, size), Image.LANCZOS
+            )
+            rendered[name] = {}
+            for extension, image_format in FORMATS:
+                buffer = BytesIO()
+                image = resized if image_format == 'WEBP' else _flatten(
+                    resized
+                )
+                image.save(
+                    buffer, image_format,
+                    quality=IMAGE_DERIVATIVES['QUALITY'], optimize=True,
+                )
+                rendered[name][extension] = buffer.getvalue()
+        return rendered
+
+
+def delete_derivatives(derivatives):
+    for name, files in derivatives.items():
+        if name == 'source':
+            continue
+        for stored in files.values():
+            default_storage.delete(stored)
+
+
+def generate_derivatives(recipe_id, force=False):
+    '''Create and store the derivatives of the current image of a recipe.
+
+    The result is saved only if the image did not change in the meantime,
+    derivatives of the previous image are deleted.
+    '''
+    recipe = Recipe.objects.filter(pk=recipe_id).only(
+        'image', 'image_derivatives'
+    ).first()
+    if recipe is None or not recipe.image:
+        return
+    source = recipe.image.name
+    previous = recipe.image_derivatives
+    if previous.get('source') == source and not force:
+        return
+
+    derivatives = {'source': source}
+    try:
+        with recipe.image.open('rb') as file:
+            rendered = render_derivatives(file)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # Clients keep getting the original for an unreadable image.
+        logger.warning('Cannot create derivatives of %s', source)
+        rendered = {}
+
+    stem = os.path.splitext(os.path.basename(source))[0]
+    for name, files in rendered.items():
+        derivatives[name] = {
+            extension: default_storage.save(
+                f'{DIRECTORY}{stem}-{name}.{extension}', ContentFile(content)
+            )
+            for extension, content in files.items()
+        }
+
+    updated = Recipe.objects.filter(pk=recipe_id, image=source).update(
+        image_derivatives=derivatives
+    )
+    if not updated:
+        delete_derivatives(derivatives)
+    elif previous:
+        delete_derivatives(previous)
+
+
+def _run(recipe_id):
+    try:
+        generate_derivatives(recipe_id)
+    except Exception:
+        logger.exception('Image derivatives of recipe %s failed', recipe_id)
+    finally:
+        with _lock:
+            _pending.discard(recipe_id)
+        # Worker threads own their connections, do not leave them open.
+        connection.close()
+
+
+def schedule_derivatives(recipe_ids):
+    '''Generate derivatives in the background thread pool of this process.
+
+    A lost task leaves the original image in use until the
+    generateimagederivatives command fills the gap. SQLite allows a
+    single writer, a background write would deadlock with the open
+    transactions of requests, so there the work is done right away.
+    '''
+    global _executor
+    if connection.vendor == 'sqlite':
+        for recipe_id in recipe_ids:
+            generate_derivatives(recipe_id)
+        return
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=IMAGE_DERIVATIVES['WORKERS'],
+                thread_name_prefix='image-derivatives',
+            )
+        for recipe_id in recipe_ids:
+            if recipe_id not in _pending:
+                _pending.add(recipe_id)
+                _executor.submit(_run, recipe_id)
+
+
+def _recipe_saved(sender, instance, **kwargs):
+    if instance.image and (
+        instance.image_derivatives.get('source') != instance.image.name
+    ):
+        pk = instance.pk
+        transaction.on_commit(lambda: schedule_derivatives([pk]))
+
+
+def _recipe_deleted(sender, instance, **kwargs):
+    derivatives = instance.image_derivatives
+    if derivatives:
+        transaction.on_commit(lambda: delete_derivatives(derivatives))
+
+
+def connect_signals():
+    post_save.connect(
+        _recipe_saved, sender=Recipe, dispatch_uid='image_derivatives_saved',
+    )
+    post_delete.connect(
+        _recipe_deleted, sender=Recipe,
+        dispatch_uid='image_derivatives_deleted',
+    )
@@ -0,0 +1,442 @@
+import base64
+import io
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from uuid import uuid4
+
+import django
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.utils import timezone
+from foodgram.settings import MAX_LENGHT_2, RECIPE_IMPORT
+from PIL import Image
+from recipes import counters, feed
+from recipes.autocomplete import fold
+from recipes.images import schedule_derivatives
+from recipes.models import (ImportCheckpoint, Ingredient, IngredientRecipe,
+                            Recipe, Tag, TagRecipe)
+from recipes.tag_bits import mask_of
+from users.validators import validate_name
+
+User = get_user_model()
+
+MAX_TEXT_LENGTH = Recipe._meta.get_field('text').max_length
+MAX_AMOUNT = 32767
+MAX_COOKING_TIME = 600
+MAX_REPORTED_ERRORS = 100
+
+
+class RecordError(Exception):
+    '''A line of the import that cannot be imported.'''
+
+
+def store_image(data):
+    '''Decode, verify and save a base64 image, runs in the worker pool.
+
+    Returns the stored name and None, or None and an error message.
+    '''
+    try:
+        if data.startswith('data:'):
+            data = data.split(';base64,', 1)[1]
+        content = base64.b64decode(data, validate=True)
+        with Image.open(io.BytesIO(content)) as image:
+            image.verify()
+            extension = image.format.lower()
+    except (IndexError, ValueError, OSError, Image.DecompressionBombError):
+        return None, 'Invalid image.'
+
+    name = Recipe._meta.get_field('image').generate_filename(
+        None, f'{uuid4()}.{extension}'
+    )
+    return default_storage.save(name, ContentFile(content)), None
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n'
+    ).replace('\r', '\\r')
+
+
+def _copy(cursor, model, fields, rows):
+    '''Load rows into the table of a model with COPY FROM STDIN.'''
+    quote = cursor.db.ops.quote_name
+    columns = ', '.join(
+        quote(model._meta.get_field(field).column) for field in fields
+    )
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row) + '\n')
+    buffer.seek(0)
+    cursor.copy_expert(
+        f'COPY {quote(model._meta.db_table)} ({columns}) FROM STDIN', buffer
+    )
+
+
+class RecipeImporter:
+    '''Imports recipes from NDJSON, one recipe object per line.
+
+    {"name": ..., "text": ..., "cooking_time": 30, "author": "username",
+     "tags": ["breakfast"], "image": "data:image/png;base64,...",
+     "ingredients": [{"name": ..., "measurement_unit": "г", "amount": 5}]}
+
+    Lines are validated and written in batches, each batch in its own
+    transaction, with ingredients and tags resolved through maps loaded
+    once. Images are decoded in a process pool, their resized copies are
+    scheduled once the batch is committed. Every batch stores the
+    position in the file in the ImportCheckpoint named checkpoint, in
+    its own transaction, so a resumed import neither skips nor repeats
+    a batch. Invalid lines are skipped and reported with their line
+    numbers.
+    '''
+
+    def __init__(self, author=None, batch_size=RECIPE_IMPORT['BATCH_SIZE'],
+                 workers=RECIPE_IMPORT['WORKERS'], checkpoint=None,
+                 log=None):
+        self.default_author = author
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.log = log or (lambda message: None)
+        self.stats = {'lines': 0, 'offset': 0, 'imported': 0, 'failed': 0}
+        self.errors = []
+
+    def run(self, stream, resume=False):
+        '''Import from a binary stream and return a summary.'''
+        if resume:
+            self._load_checkpoint()
+            stream.seek(self.stats['offset'])
+        self.ingredients = {
+            (fold(name), unit): pk
+            for pk, name, unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit'
+            )
+        }
+        self.tags = {
+            slug: (pk, bit)
+            for pk, slug, bit in Tag.objects.values_list('id', 'slug', 'bit')
+        }
+        self.authors = {}
+        if self.default_author is not None:
+            self.authors[self.default_author.username] = (
+                self.default_author.pk
+            )
+
+        started = time.monotonic()
+        self._imported_before = self.stats['imported']
+        # Spawned workers do not share the database connections of this
+        # process, forked ones would close them on exit.
+        executor = ProcessPoolExecutor(
+            self.workers, mp_context=get_context('spawn'),
+            initializer=django.setup,
+        ) if self.workers > 0 else None
+        try:
+            batch = []
+            line, offset = self.stats['lines'], self.stats['offset']
+            for raw in stream:
+                line += 1
+                offset += len(raw)
+                if raw.strip():
+                    batch.append((line, raw))
+                if len(batch) >= self.batch_size:
+                    self._import_batch(batch, executor, line, offset, started)
+                    batch = []
+            self._import_batch(batch, executor, line, offset, started)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        seconds = time.monotonic() - started
+        imported = self.stats['imported'] - self._imported_before
+        return {
+            'imported': self.stats['imported'],
+            'failed': self.stats['failed'],
+            'lines': self.stats['lines'],
+            'seconds': round(seconds, 3),
+            'recipes_per_second': round(imported / seconds, 1)
+            if seconds else None,
+            'errors': sorted(self.errors, key=lambda error: error['line']),
+        }
+
+    def _import_batch(self, batch, executor, line, offset, started):
+        records = []
+        for number, raw in batch:
+            try:
+                records.append((number, self._clean(raw)))
+            except RecordError as error:
+                self._fail(number, str(error))
+        records = self._resolve_authors(records)
+        records = self._store_images(records, executor)
+
+        with transaction.atomic():
+            written = [record for _, record in records]
+            self._write(written)
+            # Rows written by COPY or bulk_create send no signals.
+            feed.fan_out(
+                (record['id'], record['author_id'], record['pub_date'])
+                for record in written
+            )
+            counters.add_recipes(record['author_id'] for record in written)
+            with_images = [
+                record['id'] for record in written if record['image']
+            ]
+            transaction.on_commit(
+                lambda: schedule_derivatives(with_images)
+            )
+            self.stats['imported'] += len(records)
+            self.stats['lines'], self.stats['offset'] = line, offset
+            self._save_checkpoint()
+
+        seconds = time.monotonic() - started
+        imported = self.stats['imported'] - self._imported_before
+        self.log(
+            f'line {line}: {self.stats["imported"]} imported, '
+            f'{self.stats["failed"]} failed, '
+            f'{imported / seconds if seconds else 0:.0f} recipes/s'
+        )
+
+    def _fail(self, line, message):
+        self.stats['failed'] += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def _clean(self, raw):
+        '''Validate one line and resolve its tags and ingredients.'''
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            raise RecordError('Invalid JSON.')
+        if not isinstance(data, dict):
+            raise RecordError('A recipe must be a JSON object.')
+
+        name = data.get('name')
+        if not isinstance(name, str) or not 0 < len(name) <= MAX_LENGHT_2:
+            raise RecordError(
+                f'name must be 1 to {MAX_LENGHT_2} characters long.'
+            )
+        try:
+            validate_name(name)
+        except ValidationError as error:
+            raise RecordError(' '.join(error.messages))
+
+        text = data.get('text')
+        if not isinstance(text, str) or not 0 < len(text) <= MAX_TEXT_LENGTH:
+            raise RecordError(
+                f'text must be 1 to {MAX_TEXT_LENGTH} characters long.'
+            )
+
+        cooking_time = data.get('cooking_time')
+        if not isinstance(cooking_time, int) or isinstance(
+            cooking_time, bool
+        ) or not 1 <= cooking_time <= MAX_COOKING_TIME:
+            raise RecordError(
+                f'cooking_time must be a number from 1 to {MAX_COOKING_TIME}.'
+            )
+
+        tags = data.get('tags', [])
+        if not isinstance(tags, list) or not all(
+            isinstance(slug, str) for slug in tags
+        ):
+            raise RecordError('tags must be a list of slugs.')
+        unknown = [slug for slug in tags if slug not in self.tags]
+        if unknown:
+            raise RecordError(f'Unknown tags: {unknown}.')
+
+        ingredients = {}
+        for item in data.get('ingredients') or ():
+            if not isinstance(item, dict):
+                raise RecordError('An ingredient must be a JSON object.')
+            key = (
+                fold(str(item.get('name', ''))),
+                str(item.get('measurement_unit', '')),
+            )
+            if key not in self.ingredients:
+                raise RecordError(
+                    f'Unknown ingredient: {item.get("name")}, '
+                    f'{item.get("measurement_unit")}.'
+                )
+            amount = item.get('amount')
+            if not isinstance(amount, int) or isinstance(
+                amount, bool
+            ) or not 1 <= amount <= MAX_AMOUNT:
+                raise RecordError(
+                    f'amount must be a number from 1 to {MAX_AMOUNT}.'
+                )
+            if self.ingredients[key] in ingredients:
+                raise RecordError('Ingredients must be unique.')
+            ingredients[self.ingredients[key]] = amount
+        if not ingredients:
+            raise RecordError('Must have at least one ingredient.')
+
+        author = data.get('author')
+        if author is None:
+            if self.default_author is None:
+                raise RecordError('author is required.')
+            author = self.default_author.username
+        elif not isinstance(author, str) or not author:
+            raise RecordError('author must be a username.')
+        image = data.get('image') or None
+        if image is not None and not isinstance(image, str):
+            raise RecordError('image must be a base64 string.')
+
+        return {
+            'author': author,
+            'name': name,
+            'text': text,
+            'cooking_time': cooking_time,
+            'image': image,
+            'tags': [self.tags[slug][0] for slug in dict.fromkeys(tags)],
+            'tag_mask': mask_of(
+                self.tags[slug][1] for slug in dict.fromkeys(tags)
+            ),
+            'ingredients': ingredients,
+        }
+
+    def _resolve_authors(self, records):
+        missing = {
+            record['author'] for _, record in records
+        } - self.authors.keys()
+        if missing:
+            self.authors.update(User.objects.filter(
+                username__in=missing
+            ).values_list('username', 'id'))
+
+        resolved = []
+        for number, record in records:
+            author_id = self.authors.get(record['author'])
+            if author_id is None:
+                self._fail(number, f'Unknown author: {record["author"]}.')
+            else:
+                record['author_id'] = author_id
+                resolved.append((number, record))
+        return resolved
+
+    def _store_images(self, records, executor):
+        with_images = [
+            (number, record) for number, record in records if record['image']
+        ]
+        results = (executor.map if executor else map)(
+            store_image, [record['image'] for _, record in with_images]
+        )
+        failed = set()
+        for (number, record), (name, error) in zip(with_images, results):
+            if error is None:
+                record['image'] = name
+            else:
+                failed.add(number)
+                self._fail(number, error)
+        return [
+            (number, record) for number, record in records
+            if number not in failed
+        ]
+
+    def _write(self, records):
+        if not records:
+            return
+        connection = connections[Recipe.objects.db]
+        if connection.vendor == 'postgresql':
+            self._write_copy(connection, records)
+        else:
+            self._write_bulk(connection, records)
+
+    def _write_copy(self, connection, records):
+        '''Reserve recipe ids from the sequence, then COPY every table.'''
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                'FROM generate_series(1, %s)',
+                (Recipe._meta.db_table, len(records)),
+            )
+            now = timezone.now()
+            for (recipe_id,), record in zip(cursor.fetchall(), records):
+                record['id'] = recipe_id
+                record['pub_date'] = now
+
+            _copy(
+                cursor, Recipe,
+                ('id', 'author', 'name', 'image', 'text', 'pub_date',
+                 'cooking_time', 'tag_mask'),
+                (
+                    (record['id'], record['author_id'], record['name'],
+                     record['image'] or '', record['text'], now.isoformat(),
+                     record['cooking_time'], record['tag_mask'])
+                    for record in records
+                ),
+            )
+            _copy(
+                cursor, IngredientRecipe, ('recipe', 'ingredient', 'amount'),
+                (
+                    (record['id'], ingredient_id, amount)
+                    for record in records
+                    for ingredient_id, amount in record['ingredients'].items()
+                ),
+            )
+            _copy(
+                cursor, TagRecipe, ('recipe', 'tag'),
+                (
+                    (record['id'], tag_id)
+                    for record in records for tag_id in record['tags']
+                ),
+            )
+
+    def _write_bulk(self, connection, records):
+        now = timezone.now()
+        recipes = [
+            Recipe(
+                author_id=record['author_id'], name=record['name'],
+                text=record['text'], cooking_time=record['cooking_time'],
+                image=record['image'] or '', pub_date=now,
+                tag_mask=record['tag_mask'],
+            )
+            for record in records
+        ]
+        if connection.features.can_return_rows_from_bulk_insert:
+            Recipe.objects.bulk_create(recipes, batch_size=self.batch_size)
+        else:
+            # A raw save, like bulk_create, leaves the derived data
+            # (feeds, counters) to _import_batch.
+            for recipe in recipes:
+                recipe.save_base(raw=True)
+        for recipe, record in zip(recipes, records):
+            record['id'] = recipe.pk
+            record['pub_date'] = now
+
+        IngredientRecipe.objects.bulk_create(
+            (
+                IngredientRecipe(
+                    recipe=recipe, ingredient_id=ingredient_id, amount=amount,
+                )
+                for recipe, record in zip(recipes, records)
+                for ingredient_id, amount in record['ingredients'].items()
+            ),
+            batch_size=self.batch_size,
+        )
+        TagRecipe.objects.bulk_create(
+            (
+                TagRecipe(recipe=recipe, tag_id=tag_id)
+                for recipe, record in zip(recipes, records)
+                for tag_id in record['tags']
+            ),
+            batch_size=self.batch_size,
+        )
+
+    def _load_checkpoint(self):
+        if not self.checkpoint:
+            return
+        stats = ImportCheckpoint.objects.filter(name=self.checkpoint).values(
+            *self.stats
+        ).first()
+        if stats is not None:
+            self.stats.update(stats)
+
+    def _save_checkpoint(self):
+        if self.checkpoint:
+            ImportCheckpoint.objects.update_or_create(
+                name=self.checkpoint, defaults=self.stats,
+            )
@@ -0,0 +1,71 @@
+from django.db import connections, models
+from recipes.models import FeedEntry, Recipe, ShoppingСart
+from users.models import Follow
+
+# Indexes matching the ORDER BY and WHERE of the API querysets. They are
+# not in Meta.indexes: a generated AddIndex would lock the tables for
+# writes while it builds, here Postgres builds them CONCURRENTLY.
+INDEXES = (
+    # Recipe lists, default ordering and cursor pagination.
+    (Recipe, models.Index(
+        fields=('-pub_date', 'id'), name='recipe_pub_date_idx',
+    )),
+    # Recipes of an author and the newest recipes per author.
+    (Recipe, models.Index(
+        fields=('author', '-pub_date', '-id'),
+        name='recipe_author_pub_date_idx',
+    )),
+    # ?ordering=-popularity.
+    (Recipe, models.Index(
+        fields=('-favorites_count', '-pub_date', '-id'),
+        name='recipe_popularity_idx',
+    )),
+    # ?min_cooking_time= and ?max_cooking_time=.
+    (Recipe, models.Index(
+        fields=('cooking_time',), name='recipe_cooking_time_idx',
+    )),
+    # Subscriptions of a user in subscription order.
+    (Follow, models.Index(
+        fields=('user', 'created', 'id'), name='follow_user_created_idx',
+    )),
+    # Subscription feed of a user, newest first.
+    (FeedEntry, models.Index(
+        fields=('user', '-pub_date', 'recipe'),
+        name='feed_user_pub_date_idx',
+    )),
+    # Cart of a user; the unique constraint starts with the recipe.
+    (ShoppingСart, models.Index(
+        fields=('user', 'recipe'), name='cart_user_recipe_idx',
+    )),
+)
+
+
+def _invalid_indexes(cursor):
+    '''Indexes left invalid by an interrupted concurrent build.'''
+    cursor.execute(
+        'SELECT c.relname FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid'
+    )
+    return {name for name, in cursor.fetchall()}
+
+
+def install_indexes(using='default', **kwargs):
+    '''Create the missing indexes, run after migrate.'''
+    connection = connections[using]
+    concurrently = connection.vendor == 'postgresql'
+    with connection.cursor() as cursor:
+        existing = set()
+        for table in {model._meta.db_table for model, _ in INDEXES}:
+            existing.update(
+                connection.introspection.get_constraints(cursor, table)
+            )
+        invalid = _invalid_indexes(cursor) if concurrently else set()
+
+    options = {'concurrently': True} if concurrently else {}
+    with connection.schema_editor(atomic=False) as editor:
+        for model, index in INDEXES:
+            if index.name in invalid:
+                editor.remove_index(model, index, **options)
+            elif index.name in existing:
+                continue
+            editor.add_index(model, index, **options)
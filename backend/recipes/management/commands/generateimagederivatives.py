@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from recipes.images import generate_derivatives
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates the missing resized copies of recipe images, for example '
+        'after an import or a restart that lost queued work.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='regenerate every image, e.g. after changing the sizes',
+        )
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(image='').only(
+            'id', 'image', 'image_derivatives'
+        ).order_by('id')
+        pending = [
+            recipe.pk for recipe in recipes.iterator()
+            if options['all']
+            or recipe.image_derivatives.get('source') != recipe.image.name
+        ]
+        for recipe_id in pending:
+            generate_derivatives(recipe_id, force=options['all'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated the derivatives of {len(pending)} images.'
+        ))
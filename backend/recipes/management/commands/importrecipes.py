@@ -0,0 +1,65 @@
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from foodgram.settings import RECIPE_IMPORT
+from recipes.importer import RecipeImporter
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports recipes from an NDJSON file, one recipe per line. '
+        'Progress is stored in the database with every batch, run again '
+        'with --resume to continue after a failure.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file')
+        parser.add_argument(
+            '--author', help='username of the author of recipes that '
+            'do not name one',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=RECIPE_IMPORT['BATCH_SIZE'],
+        )
+        parser.add_argument(
+            '--workers', type=int, default=RECIPE_IMPORT['WORKERS'],
+            help='image decoding processes, 0 decodes in this process',
+        )
+        parser.add_argument(
+            '--checkpoint', help='name of the stored progress, defaults to '
+            'the absolute path of the file',
+        )
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='continue from the position stored in the checkpoint',
+        )
+
+    def handle(self, *args, **options):
+        author = None
+        if options['author']:
+            try:
+                author = User.objects.get(username=options['author'])
+            except User.DoesNotExist:
+                raise CommandError(f'Unknown author {options["author"]}.')
+
+        checkpoint = options['checkpoint'] or os.path.abspath(options['path'])
+        importer = RecipeImporter(
+            author=author,
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            checkpoint=checkpoint,
+            log=self.stdout.write,
+        )
+        with open(options['path'], 'rb') as f:
+            summary = importer.run(f, resume=options['resume'])
+
+        for error in summary['errors']:
+            self.stderr.write(f'line {error["line"]}: {error["error"]}')
+        self.stdout.write(self.style.SUCCESS(
+            f'{summary["imported"]} recipes imported, {summary["failed"]} '
+            f'failed, {summary["lines"]} lines in {summary["seconds"]} s '
+            f'({summary["recipes_per_second"]} recipes/s).'
+        ))
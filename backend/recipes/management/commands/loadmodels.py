@@ -1,34 +1,184 @@
+import csv
 import json
+import os
+import time
+from hashlib import md5
+from itertools import chain, islice
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from recipes.catalog import bump_catalog_version
 from recipes.models import Ingredient, Tag
+from recipes.tag_bits import install_tag_bits
+
+# Model, fields identifying a row, fields that may change, CSV columns.
+MODELS = {
+    'tags': (Tag, ('slug',), ('name', 'color'), ('name', 'color', 'slug')),
+    'ingredients': (
+        Ingredient, ('name', 'measurement_unit'), (),
+        ('name', 'measurement_unit'),
+    ),
+}
+
+
+def iter_json_array(f, chunk_size=64 * 1024):
+    '''Yield the items of a top-level JSON array without loading it all.'''
+    decoder = json.JSONDecoder()
+    buffer, position, started = '', 0, False
+    while True:
+        chunk = f.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('The file must contain a JSON array.')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise
+                break
+            yield item
+        if not chunk:
+            raise ValueError('The JSON array is not closed.')
+
+
+def _checksum(values):
+    return md5('\x1f'.join(map(str, values)).encode()).hexdigest()
 
 
 class Command(BaseCommand):
+    help = (
+        'Loads tags or ingredients from a JSON array or a CSV file without '
+        'header. Existing rows are updated, unchanged rows are skipped.'
+    )
 
     def add_arguments(self, parser):
         parser.add_argument('--path', type=str, help='file path')
+        parser.add_argument(
+            '--model', choices=MODELS,
+            help='detected from the first row if not given',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
 
     def handle(self, *args, **options):
         file_path = options['path']
+        if not file_path:
+            raise CommandError('--path is required.')
+        started = time.monotonic()
+
+        with open(file_path, encoding='utf-8', newline='') as f:
+            if os.path.splitext(file_path)[1].lower() == '.csv':
+                first, rows = self._csv_rows(f)
+            else:
+                first, rows = self._json_rows(f)
+            if first is None:
+                self.stdout.write('The file is empty.')
+                return
+
+            model_name = options['model'] or (
+                'tags' if 'color' in first or len(first) == 3
+                else 'ingredients'
+            )
+            columns = MODELS[model_name][3]
+            totals = self._load(
+                model_name,
+                (
+                    self._values(row, columns)
+                    for row in chain((first,), rows)
+                ),
+                options['batch_size'],
+            )
+
+        if model_name == 'tags' and totals['created']:
+            # bulk_create does not call Tag.save(), which picks the bit.
+            install_tag_bits()
+        if totals['created'] or totals['updated']:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'{model_name}: {totals["created"]} created, '
+            f'{totals["updated"]} updated, {totals["unchanged"]} unchanged, '
+            f'{totals["conflicts"]} conflicting in '
+            f'{time.monotonic() - started:.2f} s.'
+        ))
+
+    def _json_rows(self, f):
+        items = iter_json_array(f)
+        return next(items, None), items
+
+    def _csv_rows(self, f):
+        reader = csv.reader(f)
+        return next(reader, None), reader
+
+    def _values(self, row, columns):
+        '''A JSON object or a CSV row as a tuple in column order.'''
+        try:
+            if isinstance(row, dict):
+                return tuple(row[column] for column in columns)
+            if len(row) == len(columns):
+                return tuple(value.strip() for value in row)
+        except (KeyError, TypeError):
+            pass
+        raise CommandError(f'Expected the fields {columns}, got {row}.')
+
+    def _load(self, model_name, rows, batch_size):
+        model, key_fields, content_fields, columns = MODELS[model_name]
+        totals = dict.fromkeys(
+            ('created', 'updated', 'unchanged', 'conflicts'), 0
+        )
+        count_before = model.objects.count()
+        attempted = 0
+        with transaction.atomic():
+            while True:
+                batch = {}
+                for values in islice(rows, batch_size):
+                    row = dict(zip(columns, values))
+                    # A repeated key in the file: the last row wins.
+                    batch[tuple(row[field] for field in key_fields)] = row
+                if not batch:
+                    break
+                new, updated, unchanged = self._upsert_batch(
+                    model, key_fields, content_fields, batch
+                )
+                attempted += new
+                totals['updated'] += updated
+                totals['unchanged'] += unchanged
+
+        totals['created'] = model.objects.count() - count_before
+        totals['conflicts'] = attempted - totals['created']
+        return totals
+
+    def _upsert_batch(self, model, key_fields, content_fields, batch):
+        '''Insert new rows and update changed ones, return the counts.'''
+        existing = {
+            tuple(row[field] for field in key_fields): row
+            for row in model.objects.filter(**{
+                f'{key_fields[0]}__in': {key[0] for key in batch},
+            }).values('pk', *key_fields, *content_fields)
+            if tuple(row[field] for field in key_fields) in batch
+        }
+
+        new, changed = [], []
+        for key, row in batch.items():
+            current = existing.get(key)
+            if current is None:
+                new.append(model(**row))
+            elif _checksum(
+                current[field] for field in content_fields
+            ) != _checksum(row[field] for field in content_fields):
+                changed.append(model(pk=current['pk'], **row))
 
-        with open(file_path, encoding='utf-8') as f:
-            jsondata = json.load(f)
-            if 'color' in jsondata[0]:
-                for line in jsondata:
-                    if not Tag.objects.filter(
-                       slug=line['slug']).exists():
-                        Tag.objects.create(
-                            name=line['name'],
-                            color=line['color'],
-                            slug=line['slug'],
-                        )
-            elif 'measurement_unit' in jsondata[0]:
-                for line in jsondata:
-                    if not Ingredient.objects.filter(
-                       name=line['name'],
-                       measurement_unit=line['measurement_unit']).exists():
-                        Ingredient.objects.create(
-                            name=line['name'],
-                            measurement_unit=line['measurement_unit']
-                        )
+        model.objects.bulk_create(new, ignore_conflicts=True)
+        if changed:
+            model.objects.bulk_update(changed, content_fields)
+        return len(new), len(changed), len(existing) - len(changed)
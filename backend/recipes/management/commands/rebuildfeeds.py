@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from recipes import feed
+from recipes.models import FeedEntry
+
+
+class Command(BaseCommand):
+    help = (
+        'Recreates the subscription feeds from the subscriptions, e.g. '
+        'after FEED_FANOUT_LIMIT was changed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', type=int, action='append', dest='users',
+            help='rebuild only the feed of this user id, can be repeated',
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options['users']
+        with transaction.atomic():
+            feed.rebuild(user_ids)
+        entries = FeedEntry.objects.all()
+        if user_ids is not None:
+            entries = entries.filter(user_id__in=user_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f'The feeds hold {entries.count()} recipes.'
+        ))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from recipes import counters
+
+
+class Command(BaseCommand):
+    help = (
+        'Recounts favorites, carts, recipes, followers and subscriptions '
+        'and repairs the stored counters that drifted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--counter', choices=counters.COUNTERS, action='append',
+            dest='fields', help='repair only this counter, can be repeated',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            repaired = counters.recompute(options['fields'])
+        for field, rows in repaired.items():
+            self.stdout.write(f'{field}: {rows} rows repaired')
+        self.stdout.write(self.style.SUCCESS(
+            f'{sum(repaired.values())} counters repaired.'
+        ))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from recipes import shopping_list
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the stored shopping lists with totals computed from the '
+        'carts and optionally repairs them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', type=int, action='append', dest='users',
+            help='check only this user id, can be repeated',
+        )
+        parser.add_argument(
+            '--fix', action='store_true', help='rebuild mismatching lists'
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options['users']
+        expected = shopping_list.expected_totals(user_ids)
+        stored = {
+            key: amount
+            for key, amount in shopping_list.stored_totals(user_ids).items()
+            if amount
+        }
+
+        mismatches = {
+            key for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        }
+        for user_id, ingredient_id in sorted(mismatches):
+            self.stdout.write(
+                f'user {user_id}, ingredient {ingredient_id}: stored '
+                f'{stored.get((user_id, ingredient_id), 0)}, expected '
+                f'{expected.get((user_id, ingredient_id), 0)}'
+            )
+
+        broken_users = sorted({user_id for user_id, _ in mismatches})
+        if not broken_users:
+            self.stdout.write(self.style.SUCCESS(
+                f'{len(expected)} shopping list rows are consistent.'
+            ))
+            return
+
+        if not options['fix']:
+            raise CommandError(
+                f'{len(mismatches)} rows of {len(broken_users)} users '
+                'differ, run with --fix to rebuild them.'
+            )
+
+        with transaction.atomic():
+            shopping_list.rebuild(broken_users)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt the shopping lists of {len(broken_users)} users.'
+        ))
@@ -1,13 +1,21 @@
 from colorfield.fields import ColorField
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import UniqueConstraint
+from django.db import IntegrityError, models, transaction
+from django.db.models import (Exists, F, OuterRef, Prefetch, UniqueConstraint,
+                              Value, Window)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
 from foodgram.settings import MAX_LENGHT_2
+from users.models import CountersMixin, Follow
 from users.validators import validate_name
 
 User = get_user_model()
 
+# Bits of a signed 64-bit tag mask that keep it positive.
+TAG_BITS = 63
+
 
 class Tag(models.Model):
     name = models.CharField(
@@ -27,6 +35,12 @@ class Tag(models.Model):
         max_length=MAX_LENGHT_2,
         unique=True,
     )
+    bit = models.PositiveSmallIntegerField(
+        verbose_name='Bit in the tag masks of recipes',
+        unique=True,
+        null=True,
+        editable=False,
+    )
 
     class Meta:
         ordering = ('name',)
@@ -36,6 +50,34 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self.bit is not None:
+            super().save(*args, **kwargs)
+            return
+        # Tags saved at the same time can pick the same bit, the one that
+        # loses on the unique constraint picks the next free bit.
+        while True:
+            self.bit = Tag.free_bit()
+            try:
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+            except IntegrityError:
+                if not Tag.objects.filter(bit=self.bit).exclude(
+                    pk=self.pk
+                ).exists():
+                    self.bit = None
+                    raise
+            else:
+                return
+
+    @staticmethod
+    def free_bit():
+        used = set(Tag.objects.exclude(bit=None).values_list('bit', flat=True))
+        free = [bit for bit in range(TAG_BITS) if bit not in used]
+        if not free:
+            raise ValidationError(f'There can be at most {TAG_BITS} tags.')
+        return free[0]
+
 
 class Ingredient(models.Model):
     name = models.CharField(
@@ -63,7 +105,81 @@ class Ingredient(models.Model):
         return f'{self.name}, {self.measurement_unit}.'
 
 
-class Recipe(models.Model):
+class CatalogVersion(models.Model):
+    '''The one row with the version of the tag and ingredient catalogs.'''
+
+    version = models.BigIntegerField(
+        verbose_name='Version, a nanosecond timestamp',
+    )
+
+    class Meta:
+        verbose_name = 'Catalog version'
+        verbose_name_plural = 'Catalog versions'
+
+    def __str__(self):
+        return str(self.version)
+
+
+class RecipeQuerySet(models.QuerySet):
+    '''Querysets for rendering recipes with a fixed number of queries.'''
+
+    def with_related(self):
+        return self.select_related('author').prefetch_related(
+            'tags',
+            Prefetch(
+                'ingredientrecipes',
+                queryset=IngredientRecipe.objects.select_related('ingredient'),
+            ),
+        )
+
+    def with_user_flags(self, user):
+        '''Exists() flags of the user: favorite, cart and followed author.'''
+        if user.is_anonymous:
+            return self.annotate(
+                is_favorited=Value(False),
+                is_in_shopping_cart=Value(False),
+                author_is_subscribed=Value(False),
+            )
+
+        return self.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'),
+            )),
+            is_in_shopping_cart=Exists(ShoppingСart.objects.filter(
+                user=user, recipe=OuterRef('pk'),
+            )),
+            author_is_subscribed=Exists(Follow.objects.filter(
+                user=user, author=OuterRef('author_id'),
+            )),
+        )
+
+    def latest_per_author(self, author_ids, limit=None):
+        '''The newest recipes of the authors, at most limit of each.
+
+        Recipes are ranked per author with ROW_NUMBER(). Django 3.2 cannot
+        filter on a window function, so the ranked query is wrapped in a
+        subquery by hand.
+        '''
+        recipes = self.filter(author_id__in=author_ids).order_by(
+            'author_id', '-pub_date', '-pk'
+        )
+        if limit is None or not author_ids:
+            return recipes
+        ranked = self.model.objects.filter(author_id__in=author_ids).annotate(
+            rank=Window(
+                RowNumber(),
+                partition_by=F('author_id'),
+                order_by=(F('pub_date').desc(), F('pk').desc()),
+            ),
+        ).values('pk', 'rank')
+        sql, params = ranked.query.sql_with_params()
+        return recipes.filter(pk__in=RawSQL(
+            f'SELECT "id" FROM ({sql}) AS "ranked" WHERE "rank" <= %s',
+            (*params, limit),
+        ))
+
+
+class Recipe(CountersMixin, models.Model):
     author = models.ForeignKey(
         User,
         verbose_name='Athour of the recipe',
@@ -93,6 +209,12 @@ class Recipe(models.Model):
         upload_to='recipes/image/',
         blank=True,
     )
+    image_derivatives = models.JSONField(
+        verbose_name='Resized copies of the image',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
     text = models.TextField(
         verbose_name='Description of the recipe',
         max_length=500,
@@ -106,6 +228,25 @@ class Recipe(models.Model):
         default=0,
         validators=[MinValueValidator(1), MaxValueValidator(600)],
     )
+    tag_mask = models.BigIntegerField(
+        verbose_name='Bits of the tags of the recipe',
+        default=0,
+        editable=False,
+    )
+    favorites_count = models.PositiveIntegerField(
+        verbose_name='Times added to favorites',
+        default=0,
+        editable=False,
+    )
+    carts_count = models.PositiveIntegerField(
+        verbose_name='Times added to shopping carts',
+        default=0,
+        editable=False,
+    )
+
+    objects = RecipeQuerySet.as_manager()
+
+    counter_fields = ('favorites_count', 'carts_count')
 
     class Meta:
         ordering = ('-pub_date',)
@@ -228,3 +369,107 @@ class ShoppingСart(FavoriteShoppingCartModel):
                 name='unique_recipe_in_shopping_cart'
             )
         ]
+
+
+class ShoppingListItem(models.Model):
+    '''Total amount of an ingredient over all recipes in a user's cart.'''
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='User',
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_list_items',
+        verbose_name='Ingredient',
+    )
+    amount = models.IntegerField(
+        verbose_name='Total quantity',
+        default=0,
+    )
+
+    class Meta:
+        verbose_name = 'Shopping list item'
+        verbose_name_plural = 'Shopping list items'
+        constraints = [
+            UniqueConstraint(
+                fields=('user', 'ingredient'),
+                name='unique_shopping_list_item'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user} - {self.ingredient}: {self.amount}'
+
+
+class ImportCheckpoint(models.Model):
+    '''Progress of a recipe import, saved with every imported batch.'''
+
+    name = models.CharField(
+        verbose_name='Name of the import',
+        max_length=1024,
+        unique=True,
+    )
+    lines = models.PositiveIntegerField(
+        verbose_name='Lines read',
+        default=0,
+    )
+    offset = models.BigIntegerField(
+        verbose_name='Position in the file',
+        default=0,
+    )
+    imported = models.PositiveIntegerField(
+        verbose_name='Recipes imported',
+        default=0,
+    )
+    failed = models.PositiveIntegerField(
+        verbose_name='Lines failed',
+        default=0,
+    )
+
+    class Meta:
+        verbose_name = 'Import checkpoint'
+        verbose_name_plural = 'Import checkpoints'
+
+    def __str__(self):
+        return f'{self.name}: line {self.lines}'
+
+
+class FeedEntry(models.Model):
+    '''A recipe of a followed author in the subscription feed of a user.'''
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Follower',
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Recipe',
+    )
+    # The publication date of the recipe, so that a feed page is read in
+    # order from the (user, -pub_date) index. Empty only in entries made
+    # before the column, install_feeds fills them.
+    pub_date = models.DateTimeField(
+        null=True,
+        verbose_name='Publication date',
+    )
+
+    class Meta:
+        verbose_name = 'Feed entry'
+        verbose_name_plural = 'Feed entries'
+        constraints = [
+            UniqueConstraint(
+                fields=('user', 'recipe'),
+                name='unique_feed_entry'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user} - {self.recipe}'
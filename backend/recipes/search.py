@@ -0,0 +1,125 @@
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = 'russian'
+
+# The query has to repeat the indexed expression for Postgres to use it.
+VECTOR_SQL = (
+    "setweight(to_tsvector('{config}', coalesce({table}name, '')), 'A') || "
+    "setweight(to_tsvector('{config}', coalesce({table}text, '')), 'B')"
+)
+
+POSTGRESQL_DDL = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS recipes_recipe_search_idx '
+    'ON recipes_recipe USING GIN (({vector}))'.format(
+        vector=VECTOR_SQL.format(config=SEARCH_CONFIG, table='')
+    ),
+    'CREATE INDEX IF NOT EXISTS recipes_recipe_name_trgm_idx '
+    'ON recipes_recipe USING GIN (name gin_trgm_ops)',
+)
+
+# unicode61 folds case but keeps ё, so the indexed copy has ё replaced.
+SQLITE_FOLD = "replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE recipes_recipe_fts USING fts5("
+    "name, text, tokenize='unicode61 remove_diacritics 2')",
+    'CREATE TRIGGER recipes_recipe_fts_insert AFTER INSERT ON recipes_recipe '
+    'BEGIN INSERT INTO recipes_recipe_fts(rowid, name, text) '
+    'VALUES (new.id, {name}, {text}); END'.format(
+        name=SQLITE_FOLD.format(column='new.name'),
+        text=SQLITE_FOLD.format(column='new.text'),
+    ),
+    'CREATE TRIGGER recipes_recipe_fts_delete AFTER DELETE ON recipes_recipe '
+    'BEGIN DELETE FROM recipes_recipe_fts WHERE rowid = old.id; END',
+    'CREATE TRIGGER recipes_recipe_fts_update '
+    'AFTER UPDATE OF name, text ON recipes_recipe '
+    'BEGIN UPDATE recipes_recipe_fts SET name = {name}, text = {text} '
+    'WHERE rowid = new.id; END'.format(
+        name=SQLITE_FOLD.format(column='new.name'),
+        text=SQLITE_FOLD.format(column='new.text'),
+    ),
+    'INSERT INTO recipes_recipe_fts(rowid, name, text) '
+    'SELECT id, {name}, {text} FROM recipes_recipe'.format(
+        name=SQLITE_FOLD.format(column='name'),
+        text=SQLITE_FOLD.format(column='text'),
+    ),
+)
+
+# bm25() is lower for better matches, names weigh ten times the text.
+SQLITE_RANK_SQL = (
+    '(SELECT -bm25(recipes_recipe_fts, 10.0, 1.0) FROM recipes_recipe_fts '
+    'WHERE recipes_recipe_fts MATCH %s '
+    'AND recipes_recipe_fts.rowid = recipes_recipe.id)'
+)
+
+
+def install_search_indexes(using='default', **kwargs):
+    '''Create the full-text search structures, run after migrate.
+
+    The migrations of this project are generated on the server, so the
+    vendor-specific parts are created here idempotently instead.
+    '''
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            for statement in POSTGRESQL_DDL:
+                cursor.execute(statement)
+        elif connection.vendor == 'sqlite':
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'recipes_recipe_fts'"
+            )
+            if cursor.fetchone() is None:
+                for statement in SQLITE_DDL:
+                    cursor.execute(statement)
+
+
+def _fts5_query(query):
+    '''Every word must be present, the last one may be a prefix.'''
+    query = query.replace('ё', 'е').replace('Ё', 'Е')
+    words = [
+        '"{}"'.format(word.replace('"', '""')) for word in query.split()
+    ]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
+
+def search_recipes(queryset, query):
+    '''Filter recipes by a search query, annotated with search_rank.'''
+    query = query.strip()
+    if not query:
+        return queryset
+
+    vendor = connections[queryset.db].vendor
+    if vendor == 'postgresql':
+        vector = VECTOR_SQL.format(
+            config=SEARCH_CONFIG, table='"recipes_recipe".'
+        )
+        tsquery = f"websearch_to_tsquery('{SEARCH_CONFIG}', %s)"
+        return queryset.annotate(
+            search_match=RawSQL(
+                f'({vector}) @@ {tsquery} OR "recipes_recipe"."name" %% %s',
+                (query, query), output_field=BooleanField(),
+            ),
+            search_rank=RawSQL(
+                f'greatest(ts_rank({vector}, {tsquery}), '
+                'similarity("recipes_recipe"."name", %s))',
+                (query, query), output_field=FloatField(),
+            ),
+        ).filter(search_match=True).order_by('-search_rank', '-pub_date')
+
+    if vendor == 'sqlite':
+        match = _fts5_query(query)
+        return queryset.filter(pk__in=RawSQL(
+            'SELECT rowid FROM recipes_recipe_fts '
+            'WHERE recipes_recipe_fts MATCH %s', (match,),
+        )).annotate(search_rank=RawSQL(
+            SQLITE_RANK_SQL, (match,), output_field=FloatField(),
+        )).order_by('-search_rank', '-pub_date')
+
+    return queryset.filter(
+        Q(name__icontains=query) | Q(text__icontains=query)
+    )
@@ -0,0 +1,150 @@
+from django.db import transaction
+from django.db.models import (Case, Exists, F, IntegerField, OuterRef, Sum,
+                              Value, When)
+from django.db.models.signals import post_save, pre_delete
+from recipes.models import IngredientRecipe, ShoppingListItem, ShoppingСart
+
+
+def recipe_amounts(recipe_id):
+    '''{ingredient_id: amount} of a recipe.'''
+    return dict(
+        IngredientRecipe.objects.filter(recipe_id=recipe_id).values_list(
+            'ingredient_id', 'amount'
+        )
+    )
+
+
+def apply_deltas(user_ids, deltas):
+    '''Add {ingredient_id: delta} to the shopping lists of the users.'''
+    deltas = {
+        ingredient_id: delta
+        for ingredient_id, delta in deltas.items() if delta
+    }
+    user_ids = list(user_ids)
+    if not deltas or not user_ids:
+        return
+
+    ShoppingListItem.objects.bulk_create(
+        (
+            ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id)
+            for user_id in user_ids
+            for ingredient_id, delta in deltas.items() if delta > 0
+        ),
+        ignore_conflicts=True,
+    )
+    items = ShoppingListItem.objects.filter(
+        user_id__in=user_ids, ingredient_id__in=deltas,
+    )
+    items.update(amount=F('amount') + Case(
+        *(
+            When(ingredient_id=ingredient_id, then=Value(delta))
+            for ingredient_id, delta in deltas.items()
+        ),
+        output_field=IntegerField(),
+    ))
+    if any(delta < 0 for delta in deltas.values()):
+        items.filter(amount__lte=0).delete()
+
+
+def apply_recipe_change(recipe_id, old_amounts, new_amounts):
+    '''Update the lists of users whose cart holds an edited recipe.'''
+    deltas = {
+        ingredient_id: (
+            new_amounts.get(ingredient_id, 0)
+            - old_amounts.get(ingredient_id, 0)
+        )
+        for ingredient_id in old_amounts.keys() | new_amounts.keys()
+    }
+    if not any(deltas.values()):
+        return
+
+    apply_deltas(
+        ShoppingСart.objects.filter(recipe_id=recipe_id).values_list(
+            'user_id', flat=True
+        ),
+        deltas,
+    )
+
+
+def expected_totals(user_ids=None):
+    '''{(user_id, ingredient_id): amount} computed from the carts.'''
+    # One filter() call, so that both conditions use the same cart join.
+    conditions = {'recipe__shopping_cart__isnull': False}
+    if user_ids is not None:
+        conditions['recipe__shopping_cart__user_id__in'] = user_ids
+    rows = IngredientRecipe.objects.filter(**conditions).values(
+        'recipe__shopping_cart__user_id', 'ingredient_id'
+    ).annotate(total=Sum('amount')).order_by()
+    return {
+        (row['recipe__shopping_cart__user_id'], row['ingredient_id']):
+        row['total']
+        for row in rows
+    }
+
+
+def stored_totals(user_ids=None):
+    items = ShoppingListItem.objects.all()
+    if user_ids is not None:
+        items = items.filter(user_id__in=user_ids)
+    return {
+        (user_id, ingredient_id): amount
+        for user_id, ingredient_id, amount in items.values_list(
+            'user_id', 'ingredient_id', 'amount'
+        )
+    }
+
+
+def rebuild(user_ids=None):
+    '''Replace the stored lists with totals computed from the carts.'''
+    items = ShoppingListItem.objects.all()
+    if user_ids is not None:
+        items = items.filter(user_id__in=user_ids)
+    items.delete()
+    ShoppingListItem.objects.bulk_create(
+        ShoppingListItem(
+            user_id=user_id, ingredient_id=ingredient_id, amount=amount
+        )
+        for (user_id, ingredient_id), amount in expected_totals(
+            user_ids
+        ).items()
+    )
+
+
+def install_shopping_lists(batch_size=1000, **kwargs):
+    '''Fill the lists of users who have a cart but no list.
+
+    Run after migrate: carts filled before the lists existed, or before
+    a restored database, would otherwise download empty.
+    '''
+    user_ids = list(ShoppingСart.objects.filter(~Exists(
+        ShoppingListItem.objects.filter(user_id=OuterRef('user_id'))
+    )).order_by('user_id').values_list('user_id', flat=True).distinct())
+    for start in range(0, len(user_ids), batch_size):
+        with transaction.atomic():
+            rebuild(user_ids[start:start + batch_size])
+
+
+def _cart_item_saved(sender, instance, created, **kwargs):
+    if created:
+        apply_deltas([instance.user_id], recipe_amounts(instance.recipe_id))
+
+
+def _cart_item_deleted(sender, instance, **kwargs):
+    # pre_delete: when a recipe is deleted its ingredients still exist here.
+    apply_deltas([instance.user_id], {
+        ingredient_id: -amount
+        for ingredient_id, amount in recipe_amounts(
+            instance.recipe_id
+        ).items()
+    })
+
+
+def connect_signals():
+    post_save.connect(
+        _cart_item_saved, sender=ShoppingСart,
+        dispatch_uid='shopping_list_cart_item_saved',
+    )
+    pre_delete.connect(
+        _cart_item_deleted, sender=ShoppingСart,
+        dispatch_uid='shopping_list_cart_item_deleted',
+    )
@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from recipes.catalog import get_catalog_version
+from recipes.models import Recipe, Tag
+
+# Every tag owns a bit, Recipe.tag_mask has the bits of the recipe's tags,
+# so tag filters compare integers instead of joining TagRecipe.
+
+# (catalog version, {slug: bit}), replaced whole so that readers in other
+# threads never see it half updated.
+_slug_bits = (None, {})
+
+
+def mask_of(bits):
+    mask = 0
+    for bit in bits:
+        mask |= 1 << bit
+    return mask
+
+
+def slug_bits():
+    '''Bit of every tag by slug, cached until the catalog changes.
+
+    The catalog version is shared by every process, a tag added by
+    another worker or by loadmodels shows up within VERSION_TTL.
+    '''
+    global _slug_bits
+    version = get_catalog_version()
+    cached_version, bits = _slug_bits
+    if cached_version != version:
+        bits = dict(Tag.objects.exclude(bit=None).values_list('slug', 'bit'))
+        _slug_bits = (version, bits)
+    return bits
+
+
+def clear():
+    global _slug_bits
+    _slug_bits = (None, {})
+
+
+def update_masks(recipe_ids=None, tags=None):
+    '''Recompute the masks of the recipes from their tags, all if None.
+
+    One UPDATE for the reset and one per tag, tags are few.
+    '''
+    recipes = Recipe.objects.all()
+    if recipe_ids is not None:
+        recipes = recipes.filter(pk__in=recipe_ids)
+    if tags is None:
+        recipes.update(tag_mask=0)
+        tags = Tag.objects.all()
+    for tag in tags:
+        recipes.filter(tag_recipes__tag=tag).update(
+            tag_mask=F('tag_mask').bitor(1 << tag.bit)
+        )
+
+
+@transaction.atomic
+def install_tag_bits(**kwargs):
+    '''Give bits to the tags that have none and add them to the masks.
+
+    Run after migrate, fills the columns once they are created.
+    '''
+    tags = list(Tag.objects.filter(bit=None))
+    for tag in tags:
+        # Tag.save() picks the bit.
+        tag.save(update_fields=('bit',))
+    if tags:
+        update_masks(tags=tags)
+
+
+def _tag_deleted(sender, instance, **kwargs):
+    # Clear the bit before a new tag can take it.
+    if instance.bit is not None:
+        Recipe.objects.filter(
+            tag_mask=F('tag_mask').bitor(1 << instance.bit)
+        ).update(tag_mask=F('tag_mask').bitand(~(1 << instance.bit)))
+
+
+def connect_signals():
+    post_delete.connect(
+        _tag_deleted, sender=Tag, dispatch_uid='tag_bits_tag_deleted',
+    )
@@ -9,21 +9,25 @@ class UserAdmin(BaseUserAdmin):
                     'last_name', 'quantity_recipes',
                     'quantity_followers')
     list_display_links = ('username', 'id')
-    list_filter = ('email', 'username',)
+    list_filter = ('is_staff', 'is_active')
     search_fields = ('username', 'email',)
     empty_value_display = '- empty -'
 
-    @admin.display(description='Number of recipes')
+    @admin.display(description='Number of recipes', ordering='recipes_count')
     def quantity_recipes(self, obj):
-        return obj.recipes.count()
+        return obj.recipes_count
 
-    @admin.display(description='Number of followers')
+    @admin.display(
+        description='Number of followers', ordering='followers_count'
+    )
     def quantity_followers(self, obj):
-        return obj.follower.count()
+        return obj.followers_count
 
 
 @admin.register(Follow)
 class FollowAdmin(admin.ModelAdmin):
     list_display = ('user', 'id', 'author',)
+    list_select_related = ('user', 'author')
     search_fields = ('user__email', 'author__email',)
+    autocomplete_fields = ('user', 'author')
     empty_value_display = '- empty -'
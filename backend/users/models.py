@@ -5,7 +5,26 @@ from foodgram.settings import MAX_EMAIL_LENGHT, MAX_LENGHT_1
 from users.validators import validate_name, validate_username
 
 
-class User(AbstractUser):
+class CountersMixin:
+    '''Keeps save() of a loaded instance from writing back stale counters.
+
+    Counters are changed only by UPDATE ... SET x = x + 1 statements.
+    '''
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            skipped = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+                and field.attname not in skipped
+            ]
+        super().save(*args, **kwargs)
+
+
+class User(CountersMixin, AbstractUser):
 
     email = models.EmailField(
         verbose_name='Email',
@@ -34,6 +53,23 @@ class User(AbstractUser):
         verbose_name='Password',
         max_length=MAX_LENGHT_1,
     )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name='Number of recipes',
+        default=0,
+        editable=False,
+    )
+    followers_count = models.PositiveIntegerField(
+        verbose_name='Number of followers',
+        default=0,
+        editable=False,
+    )
+    following_count = models.PositiveIntegerField(
+        verbose_name='Number of subscriptions',
+        default=0,
+        editable=False,
+    )
+
+    counter_fields = ('recipes_count', 'followers_count', 'following_count')
 
     class Meta:
         ordering = ('username', )
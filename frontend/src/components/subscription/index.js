@@ -25,7 +25,10 @@ const Subscription = ({ email, first_name, last_name, username, removeSubscripti
           return <li className={styles.subscriptionItem} key={recipe.id}>
             <LinkComponent className={styles.subscriptionRecipeLink} href={`/recipes/${recipe.id}`} title={
               <div className={styles.subscriptionRecipe}>
-                <img src={recipe.image} alt={recipe.name} className={styles.subscriptionRecipeImage} />
+                <picture style={{ display: 'contents' }}>
+                  {recipe.images && <source srcSet={recipe.images.small.webp} type='image/webp' />}
+                  <img src={recipe.images ? recipe.images.small.jpeg : recipe.image} alt={recipe.name} className={styles.subscriptionRecipeImage} />
+                </picture>
                 <h3 className={styles.subscriptionRecipeTitle}>
                   {recipe.name}
                 </h3>